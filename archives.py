@@ -0,0 +1,97 @@
+import os
+import tarfile
+import time
+import zipfile
+from pathlib import Path
+
+import constants
+from copiers import temp_name
+
+
+# архив на одну папку назначения (для загрузки в фотолабораторию).
+# файлы пишутся потоком прямо из исходников, кусками по copy_chunk_size - память не зависит от размера фото.
+# архив собирается под временным именем и переименовывается, когда записан целиком.
+class ZipArchive:
+    name = 'zip'
+    suffix = '.zip'
+
+    def __init__(self, path: Path):
+        # без сжатия: jpg и raw всё равно не сжимаются, а время уходит
+        self._zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def add(self, src: Path, name: str):
+        stat = os.stat(src)
+        info = zipfile.ZipInfo(name, date_time=time.localtime(stat.st_mtime)[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = stat.st_size
+        with open(src, 'rb') as input_file, self._zip.open(info, 'w', force_zip64=True) as out_file:
+            _copy_stream(input_file, out_file, constants.copy_chunk_size)
+
+    def close(self):
+        self._zip.close()
+
+
+class TarArchive:
+    name = 'tar'
+    suffix = '.tar'
+
+    def __init__(self, path: Path):
+        self._tar = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+
+    # tarfile сам копирует содержимое небольшими кусками
+    def add(self, src: Path, name: str):
+        info = self._tar.gettarinfo(str(src), arcname=name)
+        with open(src, 'rb') as input_file:
+            self._tar.addfile(info, input_file)
+
+    def close(self):
+        self._tar.close()
+
+
+def _copy_stream(input_file, out_file, chunk_size: int):
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        out_file.write(chunk)
+
+
+archives = {
+    ZipArchive.name: ZipArchive,
+    TarArchive.name: TarArchive,
+}
+
+
+# путь архива для папки: Сортировка/А4 -> Сортировка/А4.zip
+def archive_path(out_dir: Path, fmt: str):
+    return Path(str(out_dir) + archives[fmt].suffix)
+
+
+# files - [(исходник, имя в архиве)]. cancelled() - вызывается между файлами, True - бросаем архив.
+# возвращает путь архива или None, если запись отменена.
+def write_archive(out_dir: Path, files: list, fmt: str, cancelled=None):
+    if fmt not in archives:
+        raise ValueError(f'Неизвестный формат архива: {fmt}')
+    path = archive_path(out_dir, fmt)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_name(path)
+    try:
+        archive = archives[fmt](tmp)
+        try:
+            for src, name in files:
+                if cancelled is not None and cancelled():
+                    break
+                archive.add(src, name)
+        finally:
+            archive.close()
+        if cancelled is not None and cancelled():
+            os.unlink(tmp)
+            return None
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return path
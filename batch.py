@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import constants
+from file_index import FileIndexCache
+from plan import SortPlan
+from sorters import AlbumSorter, PrintingSorter
+from summary import Summary
+
+# пакетный режим без окна: много таблиц за один запуск, например на сервере ночью.
+# python batch.py jobs.json --jobs 4 --io-limit 8
+# jobs.json - список заданий:
+# [{"table": "группа1.xlsx", "unsorted": "/фото/группа1", "extension": "ВСЕ", "sub_dir": true}, ...]
+# необязательные поля задания - см. _job_defaults.
+
+sorters = {
+    'printing': PrintingSorter,
+    'album': AlbumSorter,
+}
+
+_job_defaults = {
+    'outdir': None,  # по умолчанию - "Сортировка" внутри папки с фото, как в окне
+    'sorter': 'printing',
+    'extension': 'ВСЕ',
+    'retush_mode': False,
+    'sub_dir': False,
+    'copy_backend': constants.copy_backend,
+    'bundle_policy': constants.bundle_policy,
+    'remove_stale': False,
+    'resume': constants.resume,
+    'concurrency': constants.copy_concurrency,
+    # подбирать ли число одновременных копий по ходу копирования (concurrency - с чего начать) и в каких пределах
+    'adaptive': constants.copy_adaptive,
+    'concurrency_min': constants.copy_concurrency_min,
+    'concurrency_max': constants.copy_concurrency_max,
+    'copy_order': constants.copy_order,
+    # проверять каждую копию по хэшу
+    'verify': constants.copy_verify,
+    # архивы по папкам назначения: null, "zip" или "tar"; archive_only - только архивы, без папок
+    'archive': constants.archive_format,
+    'archive_only': constants.archive_only,
+    # готовить макеты для печати (нужен Pillow)
+    'render': constants.render_prints,
+    # только построить план и сохранить его рядом с фото
+    'dry_run': False,
+    # ничего не копировать, только сверить папку с результатом с этим планом
+    'verify_plan': None,
+}
+
+
+# лог в консоль: у каждого задания своё имя, строки разных заданий не перемешиваются
+class ConsoleLogger:
+    _lock = threading.Lock()
+
+    def __init__(self, name: str, stream=None):
+        self._name = name
+        self._stream = stream if stream is not None else sys.stdout
+
+    def info(self, message: str):
+        self._print(message, 'INFO')
+
+    def warning(self, message: str):
+        self._print(message, 'WARN')
+
+    def error(self, message: str):
+        self._print(message, 'ERR')
+
+    def _print(self, text, prefix: str):
+        with self._lock:
+            self._stream.write(f'[{prefix}] {self._name}: {text}\n')
+            self._stream.flush()
+
+    def clear(self):
+        pass
+
+
+def load_jobs(path: str):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    jobs = []
+    for i, item in enumerate(data):
+        unknown = set(item) - set(_job_defaults) - {'table', 'unsorted', 'name'}
+        if unknown:
+            raise ValueError(f'Задание {i + 1}: неизвестные поля {", ".join(sorted(unknown))}')
+        if 'table' not in item or 'unsorted' not in item:
+            raise ValueError(f'Задание {i + 1}: нужны поля table и unsorted')
+        job = dict(_job_defaults)
+        job.update(item)
+        if job['outdir'] is None:
+            job['outdir'] = os.path.join(job['unsorted'], 'Сортировка')
+        if job['sorter'] not in sorters:
+            raise ValueError(f'Задание {i + 1}: неизвестный сортировщик {job["sorter"]}')
+        job.setdefault('name', os.path.splitext(os.path.basename(job['table']))[0])
+        jobs.append(job)
+    return jobs
+
+
+# задания идут параллельно, но общий лимит одновременных копий (io_limit) и общий индекс папок с фото.
+# задания с одной папкой результата выполняются друг за другом - у папки один манифест.
+# возвращает [(задание, успешно ли, секунд)] в порядке заданий.
+def run_jobs(jobs: list, max_jobs: int, io_limit: int):
+    limit = threading.BoundedSemaphore(max(1, io_limit))
+    index_cache = FileIndexCache(exclude=[job['outdir'] for job in jobs])
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(os.path.abspath(job['outdir']), []).append(job)
+    results = {}
+    with ThreadPoolExecutor(max(1, max_jobs)) as pool:
+        for group in groups.values():
+            pool.submit(_run_group, group, limit, index_cache, results)
+    return [(job, *results[id(job)]) for job in jobs]
+
+
+def _run_group(group: list, limit, index_cache, results: dict):
+    for job in group:
+        started = time.monotonic()
+        ok = _run_job(job, limit, index_cache)
+        results[id(job)] = (ok, time.monotonic() - started)
+
+
+# у каждого задания свой цикл событий в своём потоке - как у окна
+def _run_job(job: dict, limit, index_cache):
+    logger = ConsoleLogger(job['name'])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        sorter = sorters[job['sorter']](job['table'], job['unsorted'], job['outdir'], logger, loop, Summary(logger),
+                                        job['extension'], job['retush_mode'], job['sub_dir'],
+                                        concurrency=job['concurrency'], copy_backend=job['copy_backend'],
+                                        bundle_policy=job['bundle_policy'], remove_stale=job['remove_stale'],
+                                        resume=job['resume'], io_limit=limit, index_cache=index_cache,
+                                        verify=job['verify'], copy_order=job['copy_order'],
+                                        archive=job['archive'], archive_only=job['archive_only'],
+                                        render=job['render'], adaptive=job['adaptive'],
+                                        concurrency_min=job['concurrency_min'],
+                                        concurrency_max=job['concurrency_max'])
+        if job['verify_plan']:
+            sorter.verify(SortPlan.load(Path(job['verify_plan'])))
+            return not sorter.summary.mismatches
+        if job['dry_run']:
+            plan = sorter.dry_run()
+            if plan is None:
+                logger.error('Не удалось прочитать настройки таблицы')
+                return False
+            plan_file = os.path.join(job['unsorted'], constants.plan_file_name)
+            plan.save(plan_file)
+            logger.info(f'План сохранён: {plan_file}')
+        else:
+            sorter.sort()
+        return not sorter.summary.mismatches
+    except Exception as err:
+        logger.error(f'Ошибка: {err}')
+        return False
+    finally:
+        loop.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Пакетная сортировка фото по таблицам заказов')
+    parser.add_argument('jobs', help='JSON-файл со списком заданий')
+    parser.add_argument('--jobs', dest='max_jobs', type=int, default=constants.batch_jobs,
+                        help='сколько таблиц обрабатывать одновременно')
+    parser.add_argument('--io-limit', type=int, default=constants.batch_io_limit,
+                        help='сколько копий идёт одновременно на все задания')
+    args = parser.parse_args(argv)
+    try:
+        jobs = load_jobs(args.jobs)
+    except (OSError, ValueError) as err:
+        print(f'Не удалось прочитать задания: {err}', file=sys.stderr)
+        return 2
+    results = run_jobs(jobs, args.max_jobs, args.io_limit)
+    failed = 0
+    for job, ok, elapsed in results:
+        print(f'{"OK " if ok else "ERR"} {job["name"]} - {elapsed:.1f} с')
+        failed += not ok
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# микро-бенчмарк разбора ячеек: ячейки по 10 000 строк, простой и сложный формат.
+# перед замером сверяет старый и новый разбор построчно - при расхождении завершается с кодом 1.
+# запуск из корня проекта: python -m benchmarks.cells
+import re
+import sys
+import timeit
+from collections import Counter
+from random import Random
+
+from cell_formats import parse_num_count, parse_num_count_complex
+
+lines = 10000
+repeat = 5
+
+
+# старые реализации (до cell_formats) - для сравнения
+def legacy_num_count(s: str):
+    all_num = set(re.findall('(\\d+)', s))
+    multiple_num = re.findall('(\\d+)\\s*\\(?(\\d+)\\s*шт', s)
+    range_num = re.findall('(\\d+)[ ]*-[ ]*(\\d+).*', s)
+    s1 = set(map(lambda x: x[0], multiple_num))
+    s2 = set(map(lambda x: x[1], multiple_num))
+    s3 = set(map(lambda x: x[0], range_num))
+    s4 = set(map(lambda x: x[1], range_num))
+    all_num = all_num - s1 - s2 - s3 - s4
+    result = list(multiple_num)
+    for val_st, val_fl in range_num:
+        for i in range(int(val_st), int(val_fl) + 1):
+            result.append((str(i), 1))
+    for val in all_num:
+        result.append((val, 1))
+    return result
+
+
+def legacy_num_count_complex(s: str):
+    s = s.replace('А', 'A')
+    all_list = []
+    for l in s.split('\n'):
+        all_list.extend(l.split(','))
+    result = []
+    for l in all_list:
+        a = l.split('-')
+        multiple_num = re.findall('(\\d+)\\s*\\(?(\\d+)\\s*шт', a[0])
+        if len(multiple_num) > 0:
+            result.append((multiple_num[0][0], multiple_num[0][1], a[1].strip()))
+        else:
+            all_num = re.findall('(\\d+)', a[0])
+            if len(all_num) > 0:
+                result.append((all_num[0], 1, a[1].strip()))
+    return result
+
+
+def make_simple_cell(rnd: Random):
+    cell = []
+    for _ in range(lines):
+        num = rnd.randrange(1000, 9999)
+        kind = rnd.randrange(4)
+        if kind == 0:
+            cell.append(str(num))
+        elif kind == 1:
+            cell.append(f'{num} ({rnd.randrange(2, 5)} шт)')
+        elif kind == 2:
+            cell.append(f'{num}-{num + rnd.randrange(1, 4)}')
+        else:
+            cell.append(f'{num}-{num + rnd.randrange(1, 4)} ({rnd.randrange(2, 5)}шт)')
+    return '\n'.join(cell)
+
+
+def make_complex_cell(rnd: Random):
+    cell = []
+    for _ in range(lines):
+        num = rnd.randrange(1000, 9999)
+        size = rnd.choice(['А4', 'А5', 'А6', 'A4'])
+        if rnd.randrange(2):
+            cell.append(f'{num}({rnd.randrange(2, 5)}шт)-{size}')
+        else:
+            cell.append(f'{num}-{size}')
+    return '\n'.join(cell)
+
+
+# сверка по строкам: целиком ячейки старый разбор считает неверно (выбрасывает номера, равные количеству
+# или концу диапазона в другой строке). Порядок и тип количества у старого разбора другие - сравниваем как мультимножества.
+def check(name, legacy, new, cell, normalize):
+    wrong = 0
+    for line in cell.split('\n'):
+        old = Counter(normalize(item) for item in legacy(line))
+        got = Counter(normalize(item) for item in new(line))
+        if old != got:
+            wrong += 1
+            if wrong <= 5:
+                print(f'{name}: "{line}" -> старый {sorted(old.elements())}, новый {sorted(got.elements())}')
+    if wrong:
+        print(f'{name}: расхождений {wrong}')
+    return wrong
+
+
+def bench(name, func, cell):
+    best = min(timeit.repeat(lambda: func(cell), number=1, repeat=repeat))
+    print(f'{name:<40} {best * 1000:8.2f} мс')
+    return best
+
+
+def main():
+    rnd = Random(0)
+    simple = make_simple_cell(rnd)
+    complex_ = make_complex_cell(rnd)
+    wrong = check('простой формат', legacy_num_count, parse_num_count.__wrapped__, simple,
+                  lambda item: (item[0], int(item[1])))
+    wrong += check('сложный формат', legacy_num_count_complex, lambda line: parse_num_count_complex.__wrapped__(line)[0],
+                   complex_, lambda item: (item[0], int(item[1]), item[2]))
+    if wrong:
+        return 1
+    print(f'Ячейки по {lines} строк, лучшее из {repeat}')
+    bench('простой формат, старый разбор', legacy_num_count, simple)
+    bench('простой формат, новый разбор', parse_num_count.__wrapped__, simple)
+    bench('простой формат, из кэша', parse_num_count, simple)
+    bench('сложный формат, старый разбор', legacy_num_count_complex, complex_)
+    bench('сложный формат, новый разбор', parse_num_count_complex.__wrapped__, complex_)
+    bench('сложный формат, из кэша', parse_num_count_complex, complex_)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
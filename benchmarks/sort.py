@@ -0,0 +1,315 @@
+# бенчмарк всей сортировки на синтетических данных: десятки тысяч фото (JPG и RAW) во вложенных папках,
+# таблицы заказов в простом и сложном формате, время каждого этапа и сравнение с сохранённым эталоном.
+# запуск из корня проекта:
+#   python -m benchmarks.sort                    - прогон и сравнение с эталоном (если он есть)
+#   python -m benchmarks.sort --save-baseline    - прогон и запись результата как нового эталона
+#   python -m benchmarks.sort --files 2000       - быстрый прогон на маленьком наборе
+# размеры файлов - как у настоящих (JPG ~4 МБ, RAW ~25 МБ), умноженные на --size-scale:
+# при 1 набор в 20 000 файлов занимает ~150 ГБ, по умолчанию - в тысячу раз меньше.
+# эталон baseline_sort.json снят с параметрами по умолчанию (--files 20000 --size-scale 0.001 --seed 0,
+# копирование auto). Время зависит от машины: перед сравнением изменений снимите эталон у себя
+# на неизменённом коде, с теми же параметрами.
+import argparse
+import asyncio
+import json
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from random import Random
+
+from openpyxl import Workbook
+
+import constants
+from file_index import strip_file_name
+from sorters import PrintingSorter
+from summary import Summary
+
+baseline_file = Path(__file__).with_name('baseline_sort.json')
+# во сколько раз можно стать медленнее эталона, прежде чем считать это ухудшением
+tolerance = 1.10
+
+jpg_median = 4 * 1024 * 1024
+raw_median = 25 * 1024 * 1024
+# доля кадров, снятых в JPG + RAW
+raw_share = 0.3
+# доля номеров в таблице, которых нет среди фото (опечатки)
+missing_share = 0.01
+photos_per_child = 10
+
+# столбцы таблицы: (заголовок, папка, размер для сложного формата, третье в подарок)
+simple_columns = [
+    ('А4', 'А4', 'А4', 'ДА'),
+    ('А5', 'А5', 'А5', 'НЕТ'),
+    ('А6 за 2 шт.', 'А6', 'А6', 'НЕТ'),
+    ('Магнит 5 на 7 см', 'Магнит', None, 'НЕТ'),
+    ('Фото в эл.виде', 'Эл.вид/_name_', None, 'НЕТ'),
+]
+complex_sizes = ['А4', 'А5', 'А6']
+
+
+class QuietLogger:
+    def __init__(self):
+        self.errors = 0
+
+    def info(self, message: str):
+        pass
+
+    def warning(self, message: str):
+        pass
+
+    def error(self, message: str):
+        self.errors += 1
+
+    def clear(self):
+        pass
+
+
+# фото во вложенных папках: день/камера/IMG_<номер>.JPG (+ .CR2 для части кадров)
+def make_photos(unsorted: Path, files: int, size_scale: float, rnd: Random):
+    block = bytes(rnd.getrandbits(8) for _ in range(1024 * 1024))
+    nums = []
+    written = 0
+    num = 10000
+    while written < files:
+        num += 1
+        folder = unsorted / f'день {num % 3 + 1}' / f'камера {num % 4 + 1}'
+        folder.mkdir(parents=True, exist_ok=True)
+        _write(folder / f'IMG_{num}.JPG', _size(rnd, jpg_median, size_scale), block)
+        written += 1
+        if rnd.random() < raw_share and written < files:
+            _write(folder / f'IMG_{num}.CR2', _size(rnd, raw_median, size_scale), block)
+            written += 1
+        nums.append(str(num))
+    return nums
+
+
+def _size(rnd: Random, median: int, size_scale: float):
+    return max(1, int(rnd.lognormvariate(0, 0.35) * median * size_scale))
+
+
+def _write(path: Path, size: int, block: bytes):
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+# таблица заказов. Возвращает ожидаемые пары (номер, папка) - сколько файлов должно оказаться в сортировке.
+def make_table(path: Path, nums: list, complex_format: bool, rnd: Random):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('data')
+    st = wb.create_sheet(constants.settings_sheetname)
+    existing = set(nums)
+    expected = set()
+    if complex_format:
+        columns = [('Печать', '_size_', None, 'НЕТ')]
+    else:
+        columns = simple_columns
+    ws.append(['', '№', 'ФИО'] + [column[0] for column in columns])
+    for row, start in enumerate(range(0, len(nums), photos_per_child)):
+        name = f'Ребёнок {row + 1}'
+        child = nums[start:start + photos_per_child]
+        cells = []
+        for folder in (column[1] for column in columns):
+            if complex_format:
+                cells.append(_complex_cell(child, rnd, existing, expected))
+            else:
+                cells.append(_simple_cell(child, rnd, existing, expected, folder.replace('_name_', name)))
+        ws.append(['', row + 1, name] + cells)
+    pad = [None, None]
+    if complex_format:
+        # у столбца сложного формата папка _size_, размер -> папка берётся из нераскладываемых столбцов
+        st.append(['папка для складывания'] + pad + ['_size_'] + complex_sizes)
+        st.append(['размер'] + pad + [None] + complex_sizes)
+        st.append(['распределять'] + pad + ['ДА'] + ['НЕТ'] * len(complex_sizes))
+        st.append(['сложный формат'] + pad + ['ДА'] + ['НЕТ'] * len(complex_sizes))
+    else:
+        st.append(['папка для складывания'] + pad + [column[1] for column in columns])
+        st.append(['размер'] + pad + [column[2] for column in columns])
+        st.append(['распределять'] + pad + ['ДА'] * len(columns))
+        st.append(['третье в подарок?'] + pad + [column[3] for column in columns])
+        st.append(['сложный формат'] + pad + ['НЕТ'] * len(columns))
+    wb.save(path)
+    return expected
+
+
+def _pick(child: list, rnd: Random):
+    num = rnd.choice(child)
+    if rnd.random() < missing_share:
+        num = str(int(num) + 5000000)
+    return num
+
+
+def _simple_cell(child: list, rnd: Random, existing: set, expected: set, folder: str):
+    kind = rnd.randrange(5)
+    # примерно каждая пятая ячейка пустая
+    if kind == 0:
+        return None
+    parts = []
+    for _ in range(rnd.randrange(1, 4)):
+        num = _pick(child, rnd)
+        if kind == 1 and num in existing and str(int(num) + 2) in existing:
+            parts.append(f'{num}-{int(num) + 2}')
+            expected.update((str(i), folder) for i in range(int(num), int(num) + 3) if str(i) in existing)
+            continue
+        parts.append(f'{num} ({rnd.randrange(2, 4)} шт)' if kind == 2 else num)
+        if num in existing:
+            expected.add((num, folder))
+    return ', '.join(parts)
+
+
+def _complex_cell(child: list, rnd: Random, existing: set, expected: set):
+    parts = []
+    for _ in range(rnd.randrange(1, 4)):
+        num = _pick(child, rnd)
+        size = rnd.choice(complex_sizes)
+        count = rnd.randrange(1, 4)
+        parts.append(f'{num}({count}шт)-{size}' if count > 1 else f'{num}-{size}')
+        if num in existing:
+            expected.add((num, size))
+    return '\n'.join(parts)
+
+
+# один прогон сортировки: замеры этапов из RunMetrics и проверка числа файлов
+def run_sort(root: Path, table: Path, outdir: Path, expected: set, backend: str):
+    logger = QuietLogger()
+    loop = asyncio.new_event_loop()
+    try:
+        started = time.monotonic()
+        sorter = PrintingSorter(str(table), str(root / 'unsorted'), str(outdir), logger, loop, Summary(logger),
+                                'ВСЕ', False, True, copy_backend=backend)
+        sorter.sort()
+        wall = time.monotonic() - started
+    finally:
+        loop.close()
+    report = sorter.metrics.report()
+    problems = check_results(outdir, expected)
+    for problem in problems[:10]:
+        print(f'  !! {problem}')
+    result = {'wall': round(wall, 3), 'files': report['files'], 'files_per_s': report['files_per_s'],
+              'bytes_per_s': report['bytes_per_s'], 'task_p90': report['task_latency'].get('p90'),
+              'errors': logger.errors, 'wrong': len(problems)}
+    for name, phase in report['phases'].items():
+        result[name] = phase['seconds']
+    return result
+
+
+# проверка результата по именам файлов, как check_results/check_dir в photo_sort.py:
+# каждый файл (+N_ в начале имени - число копий) лежит в заказанной для его номера папке, и все заказы на месте.
+# возвращает список проблем.
+def check_results(outdir: Path, expected: set):
+    found = set()
+    problems = []
+    for item in sorted(outdir.rglob('*')):
+        if any(part.startswith('.') for part in item.relative_to(outdir).parts) or not item.is_file():
+            continue
+        name = item.name
+        if name.startswith('+'):
+            copies, _, name = name[1:].partition('_')
+            if not copies.isdigit() or int(copies) < 2:
+                problems.append(f'неправильное число копий в файле {item}')
+        num, _ = strip_file_name(name)
+        folder = item.parent.relative_to(outdir).as_posix()
+        if (num, folder) not in expected:
+            problems.append(f'неправильная директория файла {item}')
+        found.add((num, folder))
+    for num, folder in sorted(expected - found):
+        problems.append(f'нет файла {num} в папке {folder}')
+    return problems
+
+
+def run(args):
+    rnd = Random(args.seed)
+    root = Path(args.root) if args.root else Path(tempfile.mkdtemp(prefix='photo_sort_bench_'))
+    shutil.rmtree(root / 'unsorted', ignore_errors=True)
+    results = {}
+    try:
+        started = time.monotonic()
+        nums = make_photos(root / 'unsorted', args.files, args.size_scale, rnd)
+        print(f'Набор: {args.files} файлов, {len(nums)} номеров, {time.monotonic() - started:.1f} с')
+        expected = {
+            'simple': make_table(root / 'simple.xlsx', nums, False, rnd),
+            'complex': make_table(root / 'complex.xlsx', nums, True, rnd),
+        }
+        index_cache = root / 'unsorted' / constants.file_index_dir / constants.file_index_name
+        # холодный запуск (без кэша папок и манифеста), потом повторный - ничего не поменялось
+        scenarios = [
+            ('simple', 'simple', True),
+            ('simple_repeat', 'simple', False),
+            ('complex', 'complex', True),
+        ]
+        for name, table, cold in scenarios:
+            outdir = root / f'out_{table}'
+            if cold:
+                shutil.rmtree(outdir, ignore_errors=True)
+                if index_cache.exists():
+                    index_cache.unlink()
+            print(f'{name}...')
+            results[name] = run_sort(root, root / f'{table}.xlsx', outdir, expected[table], args.backend)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return {'params': {'files': args.files, 'size_scale': args.size_scale, 'seed': args.seed,
+                       'backend': args.backend}, 'results': results}
+
+
+# сравнение по времени этапов: ratio > tolerance - стало медленнее
+def compare(current: dict, baseline: dict):
+    if current['params'] != baseline['params']:
+        print(f'Параметры эталона другие: {baseline["params"]} - сравнение может быть некорректным')
+    regressions = 0
+    print(f'{"сценарий/этап":<32} {"эталон":>9} {"сейчас":>9} {"x":>6}')
+    for scenario, result in current['results'].items():
+        base = baseline['results'].get(scenario, {})
+        for key, value in result.items():
+            if key in ('files', 'files_per_s', 'bytes_per_s', 'errors', 'wrong') or key not in base:
+                continue
+            if value is None or not base[key]:
+                continue
+            ratio = value / base[key]
+            mark = ''
+            # совсем короткие этапы сильно шумят - их не считаем
+            if ratio > tolerance and value - base[key] > 0.05:
+                mark = ' <- медленнее'
+                regressions += 1
+            print(f'{scenario + "/" + key:<32} {base[key]:>9.3f} {value:>9.3f} {ratio:>6.2f}{mark}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк сортировки на синтетических данных')
+    parser.add_argument('--files', type=int, default=20000, help='сколько файлов сгенерировать')
+    parser.add_argument('--size-scale', type=float, default=0.001, help='множитель к настоящим размерам файлов')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default=constants.copy_backend, help='способ копирования')
+    parser.add_argument('--root', help='где создавать данные (по умолчанию - временная папка)')
+    parser.add_argument('--keep', action='store_true', help='не удалять данные после прогона')
+    parser.add_argument('--baseline', default=str(baseline_file), help='файл эталона')
+    parser.add_argument('--save-baseline', action='store_true', help='записать результат как эталон')
+    args = parser.parse_args(argv)
+
+    current = run(args)
+    # неправильный результат - прогон не засчитываем, сколько бы он ни длился
+    wrong = [name for name, result in current['results'].items() if result['wrong'] or result['errors']]
+    if wrong:
+        print(f'Сортировка дала неправильный результат: {", ".join(wrong)}')
+        return 1
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=1)
+        print(f'Эталон сохранён: {baseline_path}')
+        return 0
+    if not baseline_path.exists():
+        print(json.dumps(current['results'], ensure_ascii=False, indent=1))
+        print('Эталона нет - сохраните его с --save-baseline')
+        return 0
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    return 1 if compare(current, baseline) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import re
+from functools import lru_cache
+
+import constants
+
+# простой формат. Один проход по ячейке, на каждой позиции пробуем по порядку:
+# 1. число + количество, например 1234 (2 шт)
+# 2. диапазон, возможно с количеством, например 1234-1244 или 1234-1244 (2шт)
+# 3. количество без номера, например (2шт) - номером не считается
+# 4. просто число, например 1234
+_num_count_reg = re.compile(r'(\d+)(?!\d)\s*\(?\s*(\d+)\s*шт'
+                            r'|(\d+)[ ]*-[ ]*(\d+)(?:\s*\(?\s*(\d+)\s*шт)?'
+                            r'|\(?\d+\s*шт\)?'
+                            r'|(\d+)')
+
+# сложный формат: 1234(2шт)-A4, фрагменты через запятую или с новой строки
+_fragments_reg = re.compile(r'[,\n]')
+_complex_num_reg = re.compile(r'(\d+)(?:\s*\(?\s*(\d+)\s*шт)?')
+
+
+# разбор ячейки простого формата -> ((номер, количество), ...).
+# одинаковые ячейки часто копируют в несколько столбцов - результат запоминаем по тексту ячейки.
+@lru_cache(maxsize=constants.cell_cache_size)
+def parse_num_count(s: str):
+    items = []
+    singles = set()
+    for match in _num_count_reg.finditer(s):
+        num, count, range_start, range_stop, range_count, single = match.groups()
+        if num is not None:
+            items.append((num, int(count)))
+        elif range_start is not None:
+            items.extend((str(i), 1) for i in range(int(range_start), int(range_stop) + 1))
+            # количество после диапазона, как и раньше, относится к последнему номеру
+            if range_count is not None:
+                items.append((range_stop, int(range_count)))
+        elif single is None:
+            continue
+        # одиночные номера, как и раньше, не повторяем
+        elif single not in singles:
+            singles.add(single)
+            items.append((single, 1))
+    return tuple(items)
+
+
+# разбор ячейки сложного формата -> (((номер, количество, размер), ...), ошибка или None).
+# при ошибке возвращаем то, что успели разобрать до неё.
+@lru_cache(maxsize=constants.cell_cache_size)
+def parse_num_count_complex(s: str):
+    items = []
+    # приведём все А к одному виду (английскому)
+    for fragment in _fragments_reg.split(s.replace('А', 'A')):
+        numbers, sep, size = fragment.partition('-')
+        match = _complex_num_reg.search(numbers)
+        if match is None:
+            continue
+        if not sep:
+            return tuple(items), f'Не указан размер: "{fragment.strip()}"'
+        num, count = match.groups()
+        items.append((num, int(count) if count else 1, size.partition('-')[0].strip()))
+    return tuple(items), None
@@ -1,3 +1,5 @@
+import os
+
 extensions = [
     '.jpg', '.jpeg', '.cr2', '.cr3', '.crw', '.raf', '.raw', '.rwl', '.rw2',
     '.ari', '.dpx', '.arw', '.srf', '.sr2', '.bay', '.dng', '.dcr', '.r3d',
@@ -5,9 +7,149 @@ extensions = [
     '.pef', '.srw', '.x3f', '.tif', '.tiff', '.png', '.bmp', '.dib', '.gif'
 ]
 
+jpg_extensions = ['.jpg', '.jpeg']
+raw_extensions = [ext for ext in extensions
+                  if ext not in jpg_extensions + ['.tif', '.tiff', '.png', '.bmp', '.dib', '.gif']]
+# файлы-спутники, которые едут вместе с фото (настройки обработки)
+sidecar_extensions = ['.xmp']
+
+# какие файлы с одним номером копировать:
+# single - один файл (как раньше), all - все, prefer_raw - RAW, если есть, jpg_sidecar - только JPG.
+# во всех режимах, кроме single, вместе с фото копируется и xmp.
+bundle_policy = 'single'
+bundle_policies = {
+    'Один файл': 'single',
+    'Все файлы': 'all',
+    'RAW, если есть': 'prefer_raw',
+    'JPG + XMP': 'jpg_sidecar',
+}
+
 settings_sheetname = 'settings'
 
+# сколько разных текстов ячеек помним при разборе таблицы
+cell_cache_size = 4096
+
 settings_list_reg = ['папка для складывания', 'размер', 'распределять', 'третье в подарок?', 'раскладывать для ретуши',
                      'сложный формат']
 
+# кэш списка файлов несортированной папки - в своей подпапке внутри папки с фото:
+# запись кэша (временный файл + переименование) тогда не меняет состояние самой папки с фото
+file_index_cache = True
+file_index_dir = '.photo_sort'
+file_index_name = 'index.json'
+# сколько папок просматриваем параллельно (если включены подпапки)
+scan_workers = 8
+
+# манифест сортировки (лежит в папке с результатом): при повторном запуске копируется только изменённое
+manifest_name = '.photo_sort_manifest.json'
+# журнал готовых файлов текущего запуска - по нему прерванная сортировка продолжается с места остановки
+journal_name = '.photo_sort_journal'
+resume = True
+
+# план сортировки после пробного запуска (лежит в папке с фото)
+plan_file_name = 'sort_plan.json'
+# свои файлы программы в папке с фото - в отчёте "Обработано файлов" их не считаем
+own_files = {plan_file_name}
+
+# в каком порядке копировать: 'table' - как в таблице, 'destination' - по папкам назначения,
+# 'source' - по расположению исходников на диске (карта памяти, HDD)
+copy_order = 'destination'
+# что показываем в окне -> порядок копирования
+copy_orders = {
+    'По папкам назначения': 'destination',
+    'По расположению фото': 'source',
+    'Как в таблице': 'table',
+}
+# для скольких следующих задач просим ОС заранее читать исходники
+readahead_tasks = 4
+# сколько файлов копируем одновременно
+copy_concurrency = 5
+# подбирать ли число одновременных копий по ходу копирования (copy_concurrency - с чего начинаем) и в каких пределах
+copy_adaptive = True
+copy_concurrency_min = 1
+copy_concurrency_max = 16
+# как часто (с) пересматриваем число копий и какое изменение скорости считаем заметным (доля)
+copy_adapt_interval = 0.5
+copy_adapt_gain = 0.05
+# сколько задач может ждать копирования, пока разбирается таблица
+pipeline_queue_size = 100
+# при разборе параллельно с копированием: сколько новых задач копим, прежде чем упорядочить их и отдать в работу.
+# иначе порядок (copy_order) действовал бы только внутри одной строки таблицы. Для 'table' не копим.
+pipeline_order_window = 1000
+
+# способ копирования файлов: auto, kernel (copy_file_range/sendfile), stream (кусками через буфер),
+# hardlink (жёсткие ссылки), reflink (клонирование блоков)
+copy_backend = 'auto'
+# что показываем в окне -> способ копирования
+copy_modes = {
+    'Копировать': 'auto',
+    'Жёсткие ссылки': 'hardlink',
+    'Reflink (клон)': 'reflink',
+}
+# размер буфера при потоковом копировании
+copy_chunk_size = 1024 * 1024
+# сколько байт отдаём ядру за один системный вызов
+copy_kernel_chunk_size = 64 * 1024 * 1024
+# файл пишется под временным именем .<имя><суффикс>, потом переименовывается
+copy_temp_suffix = '.part'
+# сбрасывать ли каждый файл на диск перед переименованием (медленнее, но переживает выдёргивание флешки)
+copy_fsync = True
+# проверять ли каждую копию по хэшу (дольше: копия перечитывается с диска) и каким алгоритмом
+copy_verify = False
+verify_algorithm = 'blake2b'
+# сколько файлов одновременно проверяем при сверке папки с результатом с планом
+verify_workers = 4
+
+# архивы по папкам назначения для фотолаборатории (archives.py): None - без архивов, 'zip' (без сжатия), 'tar'
+archive_format = None
+# True - только архивы, папки с копиями не раскладываем
+archive_only = False
+# что показываем в окне -> формат архивов
+archive_modes = {
+    'Без архивов': None,
+    'ZIP (без сжатия)': 'zip',
+    'TAR': 'tar',
+}
+
+# макеты для печати (render.py, нужен Pillow): JPEG под размер отпечатка в подпапке каждой папки размера
+render_prints = False
+render_dir_name = 'Печать'
+# кэш готовых макетов в папке с результатом
+render_cache_name = '.photo_sort_render'
+# сколько процессов считают макеты (None - по числу ядер)
+render_workers = None
+# из каких исходников готовим макеты (RAW - нет)
+render_extensions = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+print_dpi = 300
+render_quality = 95
+# размер отпечатка (как в строке "размер" листа настроек, А -> A) -> (ширина, высота) в мм
+print_sizes = {
+    'A3': (297, 420),
+    'A4': (210, 297),
+    'A5': (148, 210),
+    'A6': (105, 148),
+    '10X15': (102, 152),
+    '13X18': (127, 178),
+    '15X21': (152, 216),
+    '20X30': (203, 305),
+}
+
+# замеры запуска (metrics.py): сохранять ли их в папку с результатом (<имя>.json и <имя>.csv)
+metrics_report = True
+metrics_name = '.photo_sort_metrics'
+# как часто (с) запоминать длину очереди копирования
+metrics_sample_interval = 0.1
+
+# пакетный режим (batch.py): сколько таблиц одновременно и сколько копий одновременно на все таблицы
+batch_jobs = 4
+batch_io_limit = 8
+
+# окно: как часто (мс) забирать сообщения лога и обновлять ход сортировки
+log_flush_interval = 100
+progress_interval = 200
+# сколько последних строк лога держим в окне; полный лог - в файле
+log_view_lines = 2000
+# полный лог - в папке пользователя: окно может быть запущено из папки, куда писать нельзя
+log_file = os.path.join(os.path.expanduser('~'), '.photo_sort', 'photo_sort.log')
+
 version = 'v0.6'
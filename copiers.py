@@ -0,0 +1,331 @@
+import asyncio
+import errno
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import constants
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# способы копирования файла. Копирование идёт в пуле потоков, чтобы не блокировать цикл событий,
+# при этом файл целиком в память не читается - память не зависит от размера файла.
+# файл пишется под временным именем и переименовывается, только когда записан целиком:
+# если программа или диск отвалились посреди копирования, под итоговым именем обрезанных файлов не будет.
+# verify - проверка копий: хэш исходника считается на лету из тех же данных, что пишутся в копию
+# (исходник второй раз не читается), записанная копия перечитывается с диска и сверяется.
+# не совпало - копия удаляется, файл попадает в mismatches, копирование падает с VerifyError.
+class StreamCopier:
+    name = 'stream'
+    # у каждого потока свой буфер, выделяется один раз и переиспользуется.
+    _local = threading.local()
+
+    # io_limit - общий на несколько сортировок семафор (пакетный режим): сколько копий идёт одновременно на всех.
+    def __init__(self, chunk_size: int = constants.copy_chunk_size, io_limit=None, verify=constants.copy_verify):
+        self._chunk_size = chunk_size
+        self._io_limit = io_limit
+        self._verify = verify
+        self._mismatches = []
+
+    # копии, не совпавшие с исходником
+    @property
+    def mismatches(self):
+        return self._mismatches
+
+    # executor - пул потоков для копий (у планировщика свой, по верхней границе числа копий), None - пул цикла событий
+    async def copy_async(self, src: Path, dst: Path, executor=None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, self._limited, self.copy, src, dst)
+
+    async def copy_many_async(self, src: Path, dsts: list, executor=None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, self._limited, self.copy_many, src, dsts)
+
+    # ждём очереди уже в потоке пула - цикл событий не блокируется
+    def _limited(self, method, *args):
+        if self._io_limit is None:
+            return method(*args)
+        with self._io_limit:
+            return method(*args)
+
+    def copy(self, src: Path, dst: Path):
+        tmp = temp_name(dst)
+        self._local.digest = None
+        try:
+            copied = self._copy(src, tmp)
+            self._check(src, tmp, dst)
+            os.replace(tmp, dst)
+        except BaseException:
+            _remove(tmp)
+            raise
+        return copied
+
+    def _copy(self, src: Path, dst: Path):
+        with open(src, 'rb') as input_file, open(dst, 'wb') as out_file:
+            advise(input_file.fileno(), 'POSIX_FADV_SEQUENTIAL')
+            copied = self._copy_stream(input_file, out_file)
+            self._sync(out_file)
+            return copied
+
+    # хэш исходника, посчитанный при копировании (_copy_stream), сверяем с тем, что реально легло на диск.
+    def _check(self, src: Path, tmp: Path, dst: Path):
+        if not self._verify:
+            return
+        expected = getattr(self._local, 'digest', None)
+        self._local.digest = None
+        # копия сделана без чтения данных (ссылка, reflink) - сверять нечего
+        if expected is None:
+            return
+        if file_digest(tmp, drop_cache=True) != expected:
+            self._mismatches.append((src, dst))
+            raise VerifyError(f'Копия не совпадает с исходником: {dst}')
+
+    # за один проход чтения пишем кусок сразу во все файлы назначения.
+    def copy_many(self, src: Path, dsts: list):
+        if not dsts:
+            return 0
+        tmps = [temp_name(dst) for dst in dsts]
+        self._local.digest = None
+        out_files = []
+        try:
+            try:
+                for tmp in tmps:
+                    out_files.append(open(tmp, 'wb'))
+                with open(src, 'rb') as input_file:
+                    advise(input_file.fileno(), 'POSIX_FADV_SEQUENTIAL')
+                    copied = self._copy_stream(input_file, *out_files)
+                for out_file in out_files:
+                    self._sync(out_file)
+            finally:
+                for out_file in out_files:
+                    out_file.close()
+            digest = getattr(self._local, 'digest', None)
+            for tmp, dst in zip(tmps, dsts):
+                self._local.digest = digest
+                self._check(src, tmp, dst)
+            for tmp, dst in zip(tmps, dsts):
+                os.replace(tmp, dst)
+        except BaseException:
+            for tmp in tmps:
+                _remove(tmp)
+            raise
+        return copied
+
+    # подсказка ОС: эти файлы скоро будем читать - пусть начнёт читать их заранее
+    @staticmethod
+    def will_need(paths: list):
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                advise(fd, 'POSIX_FADV_WILLNEED')
+            finally:
+                os.close(fd)
+
+    # данные на диск до переименования - иначе после сбоя питания под итоговым именем может оказаться пустой файл
+    @staticmethod
+    def _sync(out_file):
+        if constants.copy_fsync:
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+    def _buffer(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) != self._chunk_size:
+            buffer = memoryview(bytearray(self._chunk_size))
+            self._local.buffer = buffer
+        return buffer
+
+    def _copy_stream(self, input_file, *out_files):
+        buffer = self._buffer()
+        hasher = make_hasher() if self._verify else None
+        copied = 0
+        while True:
+            read = input_file.readinto(buffer)
+            if not read:
+                break
+            for out_file in out_files:
+                out_file.write(buffer[:read])
+            if hasher is not None:
+                hasher.update(buffer[:read])
+            copied += read
+        if hasher is not None:
+            self._local.digest = hasher.digest()
+        return copied
+
+
+# копирование средствами ядра: copy_file_range (linux), затем sendfile.
+# если ни то, ни другое недоступно (другая ФС, старое ядро, не та ОС) - докопируем потоком.
+class KernelCopier(StreamCopier):
+    name = 'kernel'
+    # ошибки, при которых просто пробуем следующий способ
+    _fallback_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP,
+                        errno.EBADF, errno.ENOTSOCK, errno.EPERM}
+
+    def _copy(self, src: Path, dst: Path):
+        # данные должны пройти через программу, чтобы посчитать хэш - копируем потоком
+        if self._verify:
+            return super()._copy(src, dst)
+        with open(src, 'rb') as input_file, open(dst, 'wb') as out_file:
+            advise(input_file.fileno(), 'POSIX_FADV_SEQUENTIAL')
+            size = os.fstat(input_file.fileno()).st_size
+            copied = 0
+            for method in (self._copy_file_range, self._sendfile):
+                if copied >= size:
+                    break
+                try:
+                    copied = method(input_file.fileno(), out_file.fileno(), copied, size)
+                except OSError as err:
+                    if err.errno not in self._fallback_errors:
+                        raise
+            # файл мог вырасти, или системные вызовы недоступны - дописываем остаток потоком.
+            input_file.seek(copied)
+            out_file.seek(copied)
+            copied += self._copy_stream(input_file, out_file)
+            self._sync(out_file)
+            return copied
+
+    # исходник (возможно, с NAS) читаем один раз - в первую папку,
+    # остальные копии делаем уже с локальной первой копии.
+    def copy_many(self, src: Path, dsts: list):
+        if not dsts:
+            return 0
+        first = dsts[0]
+        copied = self.copy(src, first)
+        for dst in dsts[1:]:
+            self.copy(first, dst)
+        return copied
+
+    def _copy_file_range(self, fd_in, fd_out, offset, size):
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        if copy_file_range is None:
+            return offset
+        while offset < size:
+            sent = copy_file_range(fd_in, fd_out, min(size - offset, constants.copy_kernel_chunk_size),
+                                   offset, offset)
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+    def _sendfile(self, fd_in, fd_out, offset, size):
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile is None:
+            return offset
+        os.lseek(fd_out, offset, os.SEEK_SET)
+        while offset < size:
+            sent = sendfile(fd_out, fd_in, offset, min(size - offset, constants.copy_kernel_chunk_size))
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+
+# вместо копии - ссылка на тот же файл. Сортировка лежит на той же ФС, что и исходники,
+# так что данные не дублируются и раскладка занимает секунды.
+# если ссылку сделать нельзя (другой диск, ФС не умеет) - обычное копирование.
+class HardlinkCopier(KernelCopier):
+    name = 'hardlink'
+    _link_fallback_errors = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP,
+                             errno.ENOSYS, errno.EACCES}
+
+    def _copy(self, src: Path, dst: Path):
+        # ссылка не перезаписывает существующий файл, в отличие от копии - удаляем старый.
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        try:
+            os.link(src, dst)
+        except OSError as err:
+            if err.errno not in self._link_fallback_errors:
+                raise
+            return super()._copy(src, dst)
+        return os.stat(dst).st_size
+
+
+# reflink - копия, которая делит блоки с исходником, пока один из файлов не изменят (btrfs, xfs).
+# в отличие от жёсткой ссылки, правка файла в сортировке не портит исходник.
+class ReflinkCopier(KernelCopier):
+    name = 'reflink'
+    # linux: _IOW(0x94, 9, int)
+    _ficlone = 0x40049409
+
+    def _copy(self, src: Path, dst: Path):
+        if fcntl is None:
+            return super()._copy(src, dst)
+        with open(src, 'rb') as input_file, open(dst, 'wb') as out_file:
+            try:
+                fcntl.ioctl(out_file.fileno(), self._ficlone, input_file.fileno())
+            except OSError as err:
+                if err.errno not in self._fallback_errors and err.errno != errno.ENOTTY:
+                    raise
+            else:
+                return os.fstat(out_file.fileno()).st_size
+        return super()._copy(src, dst)
+
+
+class VerifyError(OSError):
+    pass
+
+
+def make_hasher():
+    return hashlib.new(constants.verify_algorithm)
+
+
+# posix_fadvise там, где он есть (linux); подсказка не сработала - не страшно
+def advise(fd: int, advice: str):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except OSError:
+        pass
+
+
+# хэш файла. drop_cache - сначала выкидываем файл из кэша ОС, чтобы читать то, что реально записано на диск.
+def file_digest(path: Path, drop_cache=False, chunk_size: int = constants.copy_chunk_size):
+    hasher = make_hasher()
+    with open(path, 'rb') as f:
+        if drop_cache:
+            advise(f.fileno(), 'POSIX_FADV_DONTNEED')
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.digest()
+
+
+# временное имя файла, пока он не записан целиком
+def temp_name(dst: Path):
+    return Path(dst).with_name('.' + Path(dst).name + constants.copy_temp_suffix)
+
+
+def _remove(path: Path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+copiers = {
+    StreamCopier.name: StreamCopier,
+    KernelCopier.name: KernelCopier,
+    HardlinkCopier.name: HardlinkCopier,
+    ReflinkCopier.name: ReflinkCopier,
+}
+
+
+def make_copier(name: str = constants.copy_backend, io_limit=None, verify=constants.copy_verify):
+    if name == 'auto':
+        name = KernelCopier.name if hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile') \
+            else StreamCopier.name
+    if name not in copiers:
+        raise ValueError(f'Неизвестный способ копирования: {name}')
+    return copiers[name](io_limit=io_limit, verify=verify)
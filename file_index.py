@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import constants
+from copiers import temp_name
+
+_file_name_reg = re.compile(r'\D*(\d*)[.](\w*)')
+
+
+# номер и расширение из имени файла. Если имя не подходит (нет точки) - None, None.
+# расширение - последнее, чтобы IMG_1234.CR2.xmp считался xmp, а не cr2.
+def strip_file_name(name: str):
+    match = _file_name_reg.search(name)
+    if match is None:
+        return None, None
+    return match.group(1), os.path.splitext(name)[1].lower()
+
+
+# индекс файлов несортированной папки: номер -> путь.
+# содержимое каждой папки сохраняется рядом с фото, при повторной сортировке
+# заново просматриваются только те папки, которые изменились (по mtime, размеру и числу ссылок папки).
+class FileIndex:
+    _version = 2
+
+    def __init__(self, root: Path, sub_dir=False, use_cache=constants.file_index_cache, exclude=()):
+        self._root = Path(root)
+        self._sub_dir = sub_dir
+        # папки, которые не смотрим (например, саму "Сортировку" внутри папки с фото)
+        self._exclude = {Path(path) for path in exclude}
+        self._use_cache = use_cache
+        self._cache_file = self._root / constants.file_index_dir / constants.file_index_name
+        self._cached = {}
+        self._dirs = {}
+        self._rescanned = 0
+
+    # список (номер, расширение, путь) в том же порядке, в каком шёл бы обход папок.
+    # save=False - кэш только читаем (пробный запуск ничего не пишет на диск).
+    def files(self, save=True):
+        if self._use_cache:
+            self._load()
+        self._collect()
+        files = []
+        self._walk(self._root, '', files)
+        if self._use_cache and save:
+            self._save()
+        return files
+
+    # сколько папок пришлось просмотреть заново
+    @property
+    def rescanned(self):
+        return self._rescanned
+
+    # сначала собираем содержимое всех папок (подпапки - параллельно в пуле потоков),
+    # потом обходим уже собранное в исходном порядке.
+    def _collect(self):
+        if not self._sub_dir:
+            self._store('', *self._entries(self._root, ''))
+            return
+        with ThreadPoolExecutor(constants.scan_workers) as pool:
+            pending = {pool.submit(self._entries, self._root, ''): ('', self._root)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rel, dir_path = pending.pop(future)
+                    entries = self._store(rel, *future.result())
+                    for entry in entries:
+                        if len(entry) != 1 or dir_path / entry[0] in self._exclude:
+                            continue
+                        child_rel = f'{rel}/{entry[0]}' if rel else entry[0]
+                        child = pool.submit(self._entries, dir_path / entry[0], child_rel)
+                        pending[child] = (child_rel, dir_path / entry[0])
+
+    def _store(self, rel: str, key: list, entries: list, scanned: bool):
+        self._dirs[rel] = {'key': key, 'entries': entries}
+        if scanned:
+            self._rescanned += 1
+        return entries
+
+    def _walk(self, dir_path: Path, rel: str, files: list):
+        for entry in self._dirs[rel]['entries']:
+            # папка хранится одним именем, файл - именем, номером и расширением
+            if len(entry) == 1:
+                if self._sub_dir and dir_path / entry[0] not in self._exclude:
+                    name = entry[0]
+                    self._walk(dir_path / name, f'{rel}/{name}' if rel else name, files)
+                continue
+            name, num, ext = entry
+            files.append((num, ext, dir_path / name))
+
+    def _entries(self, dir_path: Path, rel: str):
+        stat = os.stat(dir_path)
+        key = [stat.st_mtime_ns, stat.st_size, stat.st_nlink]
+        cached = self._cached.get(rel)
+        if cached is not None and cached['key'] == key:
+            return key, cached['entries'], False
+        return key, self._scan(dir_path), True
+
+    # DirEntry уже знает тип записи - лишний stat на каждый файл не нужен.
+    def _scan(self, dir_path: Path):
+        entries = []
+        with os.scandir(dir_path) as it:
+            for item in it:
+                if item.name == constants.file_index_dir:
+                    continue
+                if item.is_file():
+                    num, ext = strip_file_name(item.name)
+                    if ext is not None:
+                        entries.append([item.name, num, ext])
+                elif item.is_dir():
+                    entries.append([item.name])
+        return entries
+
+    def _load(self):
+        try:
+            with open(self._cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self._version:
+            self._cached = data.get('dirs', {})
+
+    def _save(self):
+        dirs = self._dirs
+        # без подпапок мы их не обходили - их кэш оставляем как есть.
+        if not self._sub_dir:
+            dirs = dict(self._cached)
+            dirs.update(self._dirs)
+        try:
+            # папка кэша лежит в папке с фото: её создание меняет mtime папки.
+            # поэтому сначала создаём папку, потом запоминаем состояние папки с фото, и только потом пишем.
+            # сам файл пишется под временным именем и переименовывается - это меняет только папку кэша.
+            if not self._cache_file.parent.is_dir():
+                self._cache_file.parent.mkdir()
+                if '' in dirs:
+                    stat = os.stat(self._root)
+                    dirs['']['key'] = [stat.st_mtime_ns, stat.st_size, stat.st_nlink]
+            tmp_file = temp_name(self._cache_file)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': self._version, 'dirs': dirs}, f, ensure_ascii=False)
+            os.replace(tmp_file, self._cache_file)
+        except OSError:
+            # папка только для чтения - просто работаем без кэша.
+            pass
+
+
+# общий индекс для нескольких сортировок сразу (пакетный режим): одну и ту же папку с фото
+# просматриваем один раз, остальные сортировки берут готовый список.
+# exclude - папки, которые не смотрит никто (папки с результатом всех заданий), свои исключения
+# каждой сортировки отфильтровываются уже из готового списка.
+class FileIndexCache:
+    def __init__(self, use_cache=constants.file_index_cache, exclude=()):
+        self._use_cache = use_cache
+        self._exclude = {Path(path) for path in exclude}
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def files(self, root: Path, sub_dir=False, exclude=(), save=True):
+        key = (Path(root), bool(sub_dir))
+        with self._lock:
+            entry = self._indexes.get(key)
+            if entry is None:
+                entry = self._indexes[key] = [threading.Lock(), None]
+        # пока одна сортировка смотрит папку, остальные с той же папкой ждут её результата
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = FileIndex(root, sub_dir, self._use_cache, self._exclude).files(save)
+        return _without(entry[1], {Path(path) for path in exclude} - self._exclude)
+
+
+def _without(files: list, exclude: set):
+    if not exclude:
+        return files
+    return [item for item in files if not any(parent in exclude for parent in item[2].parents)]
@@ -1,10 +1,13 @@
 import asyncio
 import os
+import queue
+import threading
+from collections import deque
+from datetime import datetime
 
 from tkinter import Button
 from tkinter import END
 from tkinter import Frame
-from tkinter import INSERT
 from tkinter import Label
 from tkinter import OptionMenu
 from tkinter import Misc
@@ -19,14 +22,24 @@ from pathlib import Path
 import constants
 from tkinter.scrolledtext import ScrolledText
 
+from plan import SortPlan
+from progress import Progress
+from summary import Summary
 from sorters import *
 
 
+# сортировка идёт в отдельном потоке, а трогать окно можно только из главного.
+# поэтому сообщения складываются в очередь, а окно забирает их по таймеру - пачкой, одной вставкой.
+# в окне держим только последние constants.log_view_lines строк, полный лог пишется в файл.
 class Logger:
-    def __init__(self, root: Misc):
+    def __init__(self, root: Misc, log_file=constants.log_file):
         self.text = ScrolledText(master=root, width=80, height=20)
         self.text.pack()
         self._root = root
+        self._queue = queue.Queue()
+        self._log_file = log_file
+        self._file = None
+        self._flush()
 
     def info(self, message: str):
         self._print(message, 'INFO')
@@ -38,58 +51,75 @@ class Logger:
         self._print(message, 'ERR')
 
     def _print(self, text, prefix: str):
-        self.text.insert(INSERT, f'[{prefix}]: {text}\n')
-        self._root.update_idletasks()
+        self._queue.put(f'[{prefix}]: {text}\n')
 
     def clear(self):
-        self.text.delete('1.0', END)
-
-
-class Summary:
-    def __init__(self, logger: Logger):
-        self._summary = {}  # dir_name: photo_num
-        self._unique_photos = set()
-        self._miss_files = set()
-        self._logger = logger
-
-    def add(self, dir_name: (str, Path), photo_count: int, photo_name=""):
-        if dir_name not in self._summary.keys():
-            self._summary[dir_name] = photo_count
-        else:
-            self._summary[dir_name] += photo_count
-        self._unique_photos.add(photo_name)
-
-    # кажись костыль не нужен больше.
-    def add_miss_file(self, num, dir, metadata):
-        # TODO: это костыль
-        if len(str(num)) == 4:
-            self._miss_files.add((num, dir, metadata))
-
-    def get(self, dir_name: (str, Path)):
-        if isinstance(dir_name, str):
-            return self._get_by_name(dir_name)
-        if dir_name in self._summary.keys():
-            return dir_name, self._summary[dir_name]
-        else:
-            return None
-
-    @property
-    def unique_files(self):
-        return self._unique_photos
-
-    @property
-    def miss_files(self):
-        return self._miss_files
-
-    def _get_by_name(self, name: str):
-        for dir_name in self._summary.keys():
-            if dir_name.name == name:
-                return dir_name, self._summary[dir_name]
-        return None
-
-    def show(self):
-        for dir in sorted(self._summary.keys()):
-            self._logger.info(f'В "{dir.name}" - {self._summary[dir]} фото')
+        # None - очистить окно
+        self._queue.put(None)
+
+    def _flush(self):
+        lines = deque(maxlen=constants.log_view_lines)
+        cleared = False
+        written = []
+        while True:
+            try:
+                line = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                lines.clear()
+                cleared = True
+                written.append(f'--- {datetime.now():%Y-%m-%d %H:%M:%S} ---\n')
+            else:
+                lines.append(line)
+                written.append(line)
+        if cleared:
+            self.text.delete('1.0', END)
+        if lines:
+            self.text.insert(END, ''.join(lines))
+            # лишние строки сверху убираем (последняя "строка" виджета всегда пустая)
+            extra = int(self.text.index('end-1c').split('.')[0]) - constants.log_view_lines - 1
+            if extra > 0:
+                self.text.delete('1.0', f'{extra + 1}.0')
+        if written:
+            self._write(written)
+        self._root.after(constants.log_flush_interval, self._flush)
+
+    def _write(self, lines: list):
+        if not self._log_file:
+            return
+        try:
+            self._write_file(lines)
+        except OSError as err:
+            # нет прав на запись - живём без файла, но говорим об этом
+            self.text.insert(END, f'[WARN]: Лог в файл не пишется ({self._log_file}): {err}\n')
+            self._log_file = None
+
+    def _write_file(self, lines: list):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self._log_file) or '.', exist_ok=True)
+            self._file = open(self._log_file, 'a', encoding='utf-8')
+        self._file.writelines(lines)
+        self._file.flush()
+
+    # окно закрыто: дописываем в файл то, что ещё в очереди (виджета уже нет), и закрываем его
+    def close(self):
+        lines = []
+        while True:
+            try:
+                line = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if line is not None:
+                lines.append(line)
+        try:
+            if lines and self._log_file:
+                self._write_file(lines)
+            if self._file is not None:
+                self._file.close()
+        except OSError:
+            pass
+        self._file = None
 
 
 class FileDialog:
@@ -129,6 +159,23 @@ class ExtChecker:
         return self._variable.get()
 
 
+# выбор из списка режимов: подпись в окне -> значение для сортировщика
+class ModeChecker:
+    def __init__(self, root: (Tk, Frame, Misc), label: str, modes: dict):
+        self._modes = modes
+        names = list(modes.keys())
+        self._variable = StringVar(root)
+        self._variable.set(names[0])
+        menu = OptionMenu(root, self._variable, *names)
+
+        label = Label(root, text=label)
+        label.pack()
+        menu.pack()
+
+    def get(self):
+        return self._modes[self._variable.get()]
+
+
 class Window:
     def __init__(self):
         self.root = Tk()
@@ -150,6 +197,10 @@ class Window:
         self.printing_table_path_fd = FileDialog(self.left_frame, 'Путь до excel-таблицы')
         self.printing_unsorted_path_fd = FileDialog(self.left_frame, 'Путь до папки с фото', ask_dir=True)
         self.printing_ext_checker = ExtChecker(self.right_frame)
+        self.copy_mode_checker = ModeChecker(self.right_frame, 'Способ раскладки', constants.copy_modes)
+        self.bundle_checker = ModeChecker(self.right_frame, 'Файлы с одним номером', constants.bundle_policies)
+        self.copy_order_checker = ModeChecker(self.right_frame, 'Порядок копирования', constants.copy_orders)
+        self.archive_checker = ModeChecker(self.right_frame, 'Архивы для печати', constants.archive_modes)
 
         self.is_retush = BooleanVar(value=False)
         self.retush_check = ttk.Checkbutton(master=self.right_frame, variable=self.is_retush, text='В одну папку')
@@ -159,32 +210,156 @@ class Window:
         self.subdir_check = ttk.Checkbutton(master=self.right_frame, variable=self.sub_dir_include, text='Просматривать подпапки?')
         self.subdir_check.pack()
 
-        self.printing_sort_button = Button(master=self.left_frame, text='Сортировать', command=self._sort_printing)
-        self.printing_sort_button.pack()
+        self.remove_stale = BooleanVar(value=False)
+        self.remove_stale_check = ttk.Checkbutton(master=self.right_frame, variable=self.remove_stale,
+                                                  text='Удалять больше не заказанные')
+        self.remove_stale_check.pack()
+
+        self.verify = BooleanVar(value=constants.copy_verify)
+        self.verify_check = ttk.Checkbutton(master=self.right_frame, variable=self.verify,
+                                            text='Проверять копии (хэш)')
+        self.verify_check.pack()
+
+        self.archive_only = BooleanVar(value=constants.archive_only)
+        self.archive_only_check = ttk.Checkbutton(master=self.right_frame, variable=self.archive_only,
+                                                  text='Только архивы (без папок)')
+        self.archive_only_check.pack()
 
-        self._loop = asyncio.get_event_loop()
+        self.render = BooleanVar(value=constants.render_prints)
+        self.render_check = ttk.Checkbutton(master=self.right_frame, variable=self.render,
+                                            text='Макеты для печати (JPEG)')
+        self.render_check.pack()
 
-    def __del__(self):
-        self._loop.close()
+        self.printing_sort_button = Button(master=self.left_frame, text='Сортировать', command=self._sort_printing)
+        self.printing_sort_button.pack()
+        self.printing_dry_run_button = Button(master=self.left_frame, text='Пробный запуск',
+                                              command=self._dry_run_printing)
+        self.printing_dry_run_button.pack()
+        self.printing_apply_plan_button = Button(master=self.left_frame, text='Применить план',
+                                                 command=self._apply_plan_printing)
+        self.printing_apply_plan_button.pack()
+        self.printing_verify_plan_button = Button(master=self.left_frame, text='Проверить по плану',
+                                                  command=self._verify_plan_printing)
+        self.printing_verify_plan_button.pack()
+        self.printing_cancel_button = Button(master=self.left_frame, text='Отмена', command=self._cancel,
+                                             state='disabled')
+        self.printing_cancel_button.pack()
+
+        self.progress_bar = ttk.Progressbar(master=self.bottom_frame, length=560, maximum=1)
+        self.progress_bar.pack()
+        self.progress_label = Label(self.bottom_frame, text='')
+        self.progress_label.pack()
+
+        self._worker = None
+        self._progress = None
 
     # Сейчас переделали под универсальный формат
     def _sort_printing(self):
+        self._start(lambda sorter: sorter.sort())
+
+    # пробный запуск: разбираем таблицу, показываем план и сохраняем его рядом с фото
+    def _dry_run_printing(self):
+        plan_file = Path(self.printing_unsorted_path_fd.get_file_name()) / constants.plan_file_name
+
+        def dry_run(sorter):
+            plan = sorter.dry_run()
+            if plan is not None:
+                plan.save(plan_file)
+                self.printing_logger.info(f'План сохранён: {plan_file}')
+        self._start(dry_run)
+
+    def _apply_plan_printing(self):
+        plan_file = fd.askopenfilename()
+        if not plan_file:
+            return
+        try:
+            plan = SortPlan.load(Path(plan_file))
+        except Exception as exc:
+            self.printing_logger.error(str(exc))
+            raise
+        self._start(lambda sorter: sorter.apply(plan))
+
+    # сверка уже разложенного с планом: ничего не копируем, только читаем
+    def _verify_plan_printing(self):
+        plan_file = fd.askopenfilename()
+        if not plan_file:
+            return
         try:
-            unsorted = self.printing_unsorted_path_fd.get_file_name()
-            outdir = os.path.join(unsorted, 'Сортировка')
-            table = self.printing_table_path_fd.get_file_name()
-            self.printing_logger.info(f'Таблица: {table}')
-            self.printing_logger.info(f'Несортированные фото: {unsorted}')
-            self.printing_logger.info(f'Сортированные фото: {outdir}')
-            summary = Summary(self.printing_logger)
-            sorter = PrintingSorter(table, unsorted, outdir,
-                                    self.printing_logger,
-                                    self._loop, summary,
-                                    self.printing_ext_checker.get(), self.is_retush.get(), self.sub_dir_include.get())
-            sorter.sort()
+            plan = SortPlan.load(Path(plan_file))
         except Exception as exc:
             self.printing_logger.error(str(exc))
             raise
+        self._start(lambda sorter: sorter.verify(plan))
+
+    # сортировка идёт в отдельном потоке со своим циклом событий - окно не зависает.
+    # настройки из окна читаем здесь, в главном потоке.
+    def _start(self, action):
+        if self._worker is not None and self._worker.is_alive():
+            self.printing_logger.warning('Сортировка уже идёт')
+            return
+        loop = asyncio.new_event_loop()
+        self._progress = Progress()
+        try:
+            sorter = self._make_sorter(loop, self._progress)
+        except Exception as exc:
+            loop.close()
+            self.printing_logger.error(str(exc))
+            raise
+        self._worker = threading.Thread(target=self._work, args=(loop, sorter, action), daemon=True)
+        self._worker.start()
+        self.printing_cancel_button.config(state='normal')
+        self._show_progress()
+
+    def _work(self, loop, sorter, action):
+        asyncio.set_event_loop(loop)
+        try:
+            action(sorter)
+        except Exception as exc:
+            self.printing_logger.error(str(exc))
+        finally:
+            loop.close()
+
+    def _cancel(self):
+        if self._progress is not None:
+            self._progress.cancel()
+            self.printing_logger.info('Отмена: ждём, пока докопируются начатые файлы...')
+        self.printing_cancel_button.config(state='disabled')
+
+    def _show_progress(self):
+        files_done, files_total, bytes_done, bytes_total, eta = self._progress.snapshot()
+        self.progress_bar.config(value=bytes_done / bytes_total if bytes_total else 0)
+        text = f'Файлов: {files_done} из {files_total}, ' \
+               f'{bytes_done / 1024 / 1024:.1f} из {bytes_total / 1024 / 1024:.1f} МБ'
+        if eta is not None and bytes_done < bytes_total:
+            text += f', осталось ~{int(eta // 60)}:{int(eta % 60):02d}'
+        self.progress_label.config(text=text)
+        if self._worker.is_alive():
+            self.root.after(constants.progress_interval, self._show_progress)
+        else:
+            self.printing_cancel_button.config(state='disabled')
+
+    def _make_sorter(self, loop, progress):
+        unsorted = self.printing_unsorted_path_fd.get_file_name()
+        outdir = os.path.join(unsorted, 'Сортировка')
+        table = self.printing_table_path_fd.get_file_name()
+        self.printing_logger.info(f'Таблица: {table}')
+        self.printing_logger.info(f'Несортированные фото: {unsorted}')
+        self.printing_logger.info(f'Сортированные фото: {outdir}')
+        summary = Summary(self.printing_logger)
+        return PrintingSorter(table, unsorted, outdir,
+                              self.printing_logger,
+                              loop, summary,
+                              self.printing_ext_checker.get(), self.is_retush.get(), self.sub_dir_include.get(),
+                              copy_backend=self.copy_mode_checker.get(),
+                              bundle_policy=self.bundle_checker.get(),
+                              remove_stale=self.remove_stale.get(),
+                              progress=progress, verify=self.verify.get(),
+                              copy_order=self.copy_order_checker.get(),
+                              archive=self.archive_checker.get(), archive_only=self.archive_only.get(),
+                              render=self.render.get())
 
     def run(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self.printing_logger.close()
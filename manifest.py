@@ -0,0 +1,168 @@
+import json
+import os
+from pathlib import Path
+
+import constants
+from copiers import temp_name
+
+
+# манифест прошлой сортировки: какие файлы лежат в папке с результатом, из какого исходника
+# (путь, размер, mtime) и с каким числом копий. При повторной сортировке по нему не копируем то, что не менялось:
+# файл на месте - просто переименовываем под новое число копий.
+# пока сортировка идёт, каждый готовый файл дописывается в журнал. Если запуск оборвался (манифест не записан),
+# resume - следующий запуск берёт готовые файлы из журнала и продолжает с места остановки.
+class Manifest:
+    _version = 1
+
+    def __init__(self, outdir: Path, resume=constants.resume):
+        self._outdir = Path(outdir)
+        self._file = self._outdir / constants.manifest_name
+        self._journal_file = self._outdir / constants.journal_name
+        self._journal = None
+        self._old = {}
+        self._new = {}
+        self._stats = {}
+        self._reused = 0
+        self._resumed = 0
+        self._resume = resume
+        self._load()
+        # без продолжения журнал прерванного запуска затирается первой же записью -
+        # пока ничего не копировали (пробный запуск), папку с результатом не трогаем.
+        if resume:
+            self._load_journal()
+
+    @property
+    def reused(self):
+        return self._reused
+
+    # сколько готовых файлов нашлось в журнале прерванного запуска
+    @property
+    def resumed(self):
+        return self._resumed
+
+    # исходник не менялся и прошлая копия на месте - переносим её под новое имя и не копируем.
+    def reuse(self, src: Path, dst: Path):
+        prev = self._old.get(self._key(dst.parent, src))
+        if prev is None:
+            return False
+        stat = self.source_stat(src)
+        if prev['source'] != str(src) or prev['size'] != stat.st_size or prev['mtime_ns'] != stat.st_mtime_ns:
+            return False
+        old = dst.parent / prev['name']
+        try:
+            # недокопированный или испорченный файл - копируем заново
+            if os.stat(old).st_size != stat.st_size:
+                return False
+            if old != dst:
+                old.replace(dst)
+        except OSError:
+            return False
+        self._reused += 1
+        return True
+
+    # состояние исходника запоминаем один раз - на момент копирования
+    def source_stat(self, src: Path):
+        stat = self._stats.get(src)
+        if stat is None:
+            stat = self._stats[src] = os.stat(src)
+        return stat
+
+    def record(self, src: Path, dst: Path, count: int):
+        self._new[self._key(dst.parent, src)] = self._entry(src, dst, count)
+
+    # файл готов (скопирован или взят с прошлого раза) - сразу дописываем в журнал.
+    def journal(self, src: Path, dst: Path, count: int):
+        if self._journal is None:
+            self._journal = open(self._journal_file, 'a' if self._resume else 'w', encoding='utf-8')
+            self._resume = True
+        line = {'key': self._key(dst.parent, src), 'entry': self._entry(src, dst, count)}
+        self._journal.write(json.dumps(line, ensure_ascii=False) + '\n')
+        self._journal.flush()
+
+    def _entry(self, src: Path, dst: Path, count: int):
+        stat = self.source_stat(src)
+        return {
+            'source': str(src),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'name': dst.name,
+            'count': count,
+        }
+
+    # записываем манифест этого запуска. То, что в этот раз не заказано:
+    # remove_stale - удаляем из папки с результатом, иначе оставляем в манифесте как есть.
+    # возвращает список удалённых файлов.
+    def save(self, remove_stale=False):
+        removed = []
+        for key, entry in self._old.items():
+            if key in self._new:
+                continue
+            if not remove_stale:
+                self._new[key] = entry
+                continue
+            out_file = self._outdir / Path(key).parent / entry['name']
+            try:
+                out_file.unlink()
+                removed.append(out_file)
+            except OSError:
+                pass
+        tmp_file = temp_name(self._file)
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': self._version, 'files': self._new}, f, ensure_ascii=False)
+        os.replace(tmp_file, self._file)
+        # сортировка завершена - журнал и недописанные файлы прерванных запусков больше не нужны
+        self._remove_journal()
+        self._remove_temp_files()
+        return removed
+
+    # запуск прерван (отменён) - манифест не пишем, журнал оставляем для продолжения
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _remove_journal(self):
+        self.close()
+        try:
+            self._journal_file.unlink()
+        except OSError:
+            pass
+
+    def _remove_temp_files(self):
+        for out_dir in {(self._outdir / key).parent for key in self._new}:
+            for tmp in out_dir.glob('.*' + constants.copy_temp_suffix):
+                try:
+                    tmp.unlink()
+                except OSError:
+                    pass
+
+    def _key(self, out_dir: Path, src: Path):
+        try:
+            out_dir = Path(out_dir).relative_to(self._outdir)
+        except ValueError:
+            pass
+        return (Path(out_dir) / src.name).as_posix()
+
+    def _load(self):
+        try:
+            with open(self._file, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self._version:
+            self._old = data.get('files', {})
+
+    def _load_journal(self):
+        try:
+            with open(self._journal_file, encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # последняя строка могла не дописаться
+                continue
+            self._old[record['key']] = record['entry']
+            self._resumed += 1
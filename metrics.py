@@ -0,0 +1,137 @@
+import csv
+import json
+import math
+import time
+from contextlib import contextmanager
+
+import constants
+
+
+# замеры одного запуска: время этапов, скорость, задержка копирования задач, длина очереди.
+# этапы могут быть вложены (просмотр папки идёт внутри разбора таблицы, разбор - внутри копирования),
+# поэтому для каждого считаем и полное время (wall), и собственное - без вложенных этапов (seconds).
+# сумма собственных времён - это время всего запуска.
+class RunMetrics:
+    _version = 1
+
+    def __init__(self):
+        self._started = time.monotonic()
+        self._phases = {}
+        self._stack = []
+        self._latencies = []
+        self._queue_depth = []
+        self._last_sample = None
+        self._totals = {}
+        self._concurrency = {}
+        self._concurrency_changes = []
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            wall = time.monotonic() - started
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += wall
+            phase = self._phases.setdefault(name, {'seconds': 0.0, 'wall': 0.0, 'count': 0})
+            phase['seconds'] += wall - nested
+            phase['wall'] += wall
+            phase['count'] += 1
+
+    # перебор генератора, где каждый шаг засчитывается в этап name (разбор таблицы по строкам)
+    def timed(self, name: str, iterable):
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    # одна задача планировщика (комплект файлов во все его папки) от начала до конца копирования
+    def task_latency(self, seconds: float):
+        self._latencies.append(seconds)
+
+    # длину очереди запоминаем не чаще раза в metrics_sample_interval секунд
+    def queue_depth(self, depth: int):
+        now = time.monotonic()
+        if self._last_sample is not None and now - self._last_sample < constants.metrics_sample_interval:
+            return
+        self._last_sample = now
+        self._queue_depth.append((round(now - self._started, 3), depth))
+
+    # подбор числа одновременных копий: каждое изменение и итог
+    def concurrency(self, limit: int):
+        self._concurrency_changes.append((round(time.monotonic() - self._started, 3), limit))
+
+    def set_concurrency(self, settled: int, low: int, high: int):
+        self._concurrency = {'settled': settled, 'min': low, 'max': high}
+
+    def set_totals(self, files: int, size: int):
+        self._totals = {'files': files, 'bytes': size}
+
+    def report(self):
+        copy_wall = self._phases.get('copy', {}).get('wall', 0.0)
+        files = self._totals.get('files', 0)
+        size = self._totals.get('bytes', 0)
+        return {
+            'version': self._version,
+            'wall': round(time.monotonic() - self._started, 3),
+            'phases': {name: {'seconds': round(phase['seconds'], 3), 'wall': round(phase['wall'], 3),
+                              'count': phase['count']}
+                       for name, phase in self._phases.items()},
+            'files': files,
+            'bytes': size,
+            'files_per_s': round(files / copy_wall, 2) if copy_wall else None,
+            'bytes_per_s': round(size / copy_wall) if copy_wall else None,
+            'task_latency': _percentiles(self._latencies),
+            'queue_depth': self._queue_depth,
+            'concurrency': dict(self._concurrency, changes=self._concurrency_changes),
+        }
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=1)
+
+    # то же в виде таблицы: раздел, имя, значение
+    def save_csv(self, path):
+        report = self.report()
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['section', 'name', 'value'])
+            for key in ('wall', 'files', 'bytes', 'files_per_s', 'bytes_per_s'):
+                writer.writerow(['run', key, report[key]])
+            for name, phase in report['phases'].items():
+                for key, value in phase.items():
+                    writer.writerow(['phase', f'{name}.{key}', value])
+            for key, value in report['task_latency'].items():
+                writer.writerow(['task_latency', key, value])
+            for at, depth in report['queue_depth']:
+                writer.writerow(['queue_depth', at, depth])
+            for key in ('settled', 'min', 'max'):
+                if key in report['concurrency']:
+                    writer.writerow(['concurrency', key, report['concurrency'][key]])
+            for at, limit in report['concurrency']['changes']:
+                writer.writerow(['concurrency_change', at, limit])
+
+
+def _percentiles(values: list):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    # ближайший ранг
+    def percentile(p):
+        return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)], 4)
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': round(values[-1], 4),
+    }
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import constants
+from copiers import file_digest
+
+
+# план сортировки: что, куда и в скольких копиях. Строится по таблице один раз (BaseSorter.plan),
+# сохраняется в файл и может применяться сколько угодно раз, в том числе на другой машине (BaseSorter.apply).
+# пути хранятся относительно папки с фото и папки с результатом.
+class SortPlan:
+    _version = 1
+
+    def __init__(self, entries: list, missed: list, settings_hash: str):
+        # entries: {'num', 'sources': [...], 'out_dir', 'count', 'summary', 'metadata'}
+        self._entries = entries
+        # missed: [номер, папка] - фото из таблицы, которых нет в папке
+        self._missed = missed
+        self._settings_hash = settings_hash
+
+    @classmethod
+    def from_tasks(cls, tasks, missed, unsorted: Path, outdir: Path, settings_hash: str):
+        entries = []
+        for task in tasks:
+            entries.append({
+                'num': task.num,
+                'sources': [_relative(filename, unsorted) for filename in task.filenames],
+                'out_dir': _relative(task.out_dir, outdir),
+                'count': task.count,
+                'summary': task.in_summary,
+                'metadata': task.metadata,
+            })
+        missed = [[str(num), _relative(Path(out_dir), outdir)] for num, out_dir, _ in missed]
+        return cls(entries, sorted(missed), settings_hash)
+
+    @classmethod
+    def load(cls, path: Path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != cls._version:
+            raise ValueError(f'Неподдерживаемая версия плана: {data.get("version")}')
+        return cls(data['entries'], data['missed'], data['settings_hash'])
+
+    def save(self, path: Path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self._version, 'settings_hash': self._settings_hash,
+                       'entries': self._entries, 'missed': self._missed}, f, ensure_ascii=False, indent=1)
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @property
+    def missed(self):
+        return self._missed
+
+    @property
+    def settings_hash(self):
+        return self._settings_hash
+
+    # сколько байт будет записано (каждый исходник - в каждую свою папку)
+    def total_bytes(self, unsorted: Path):
+        total = 0
+        for entry in self._entries:
+            for source in entry['sources']:
+                try:
+                    total += os.stat(unsorted / source).st_size
+                except OSError:
+                    pass
+        return total
+
+    # пробный запуск: показываем план, ничего не трогая на диске
+    def show(self, logger, unsorted: Path):
+        for entry in self._entries:
+            for source in entry['sources']:
+                logger.info(f'{source} -> {entry["out_dir"]} ({entry["count"]} шт)')
+        files_num = sum(len(entry['sources']) for entry in self._entries)
+        logger.info(f'Настройки: {self._settings_hash}')
+        logger.info(f'Будет скопировано файлов: {files_num}, '
+                    f'объём - {self.total_bytes(unsorted) / 1024 / 1024:.1f} МБ.')
+        if self._missed:
+            logger.info(f'!!Внимание!!  - Отсутствуют файлы - {len(self._missed)} шт.')
+            for num, out_dir in self._missed:
+                logger.info(f'{out_dir} - {num}')
+
+    # сверка папки с результатом с планом: каждый файл на месте, нужного размера и совпадает с исходником по хэшу.
+    # файлы проверяются параллельно. Возвращает [(путь, что не так)].
+    def verify(self, unsorted: Path, outdir: Path, workers: int = constants.verify_workers):
+        pairs = []
+        for entry in self._entries:
+            for source in entry['sources']:
+                name = Path(source).name
+                if entry['count'] > 1:
+                    name = f'+{entry["count"]}_{name}'
+                pairs.append((unsorted / source, outdir / entry['out_dir'] / name))
+        with ThreadPoolExecutor(workers) as pool:
+            problems = pool.map(lambda pair: _verify_file(*pair), pairs)
+            return [(dst, problem) for (_, dst), problem in zip(pairs, problems) if problem is not None]
+
+
+def _verify_file(src: Path, dst: Path):
+    try:
+        if os.stat(dst).st_size != os.stat(src).st_size:
+            return 'размер не совпадает'
+        if file_digest(dst) != file_digest(src):
+            return 'содержимое не совпадает'
+    except FileNotFoundError as err:
+        return 'нет исходника' if err.filename == str(src) else 'нет файла'
+    except OSError as err:
+        return f'ошибка чтения: {err}'
+    return None
+
+
+def settings_hash(settings: dict, options: dict):
+    data = json.dumps({'settings': settings, 'options': options}, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _relative(path: Path, root: Path):
+    try:
+        return Path(path).relative_to(root).as_posix()
+    except ValueError:
+        return Path(path).as_posix()
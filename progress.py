@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+# ход сортировки: сколько файлов и байт уже разложено из скольких и сколько примерно осталось.
+# пишется из потока сортировки, читается окном - поэтому всё под блокировкой. Здесь же флаг отмены.
+class Progress:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._files_total = 0
+        self._bytes_total = 0
+        self._files_done = 0
+        self._bytes_done = 0
+        self._started = time.monotonic()
+
+    # появились новые файлы для раскладки (при разборе параллельно с копированием итог растёт по ходу)
+    def add_total(self, files: int, size: int):
+        with self._lock:
+            self._files_total += files
+            self._bytes_total += size
+
+    def advance(self, files: int, size: int):
+        with self._lock:
+            self._files_done += files
+            self._bytes_done += size
+
+    # новые копии больше не начинаем, уже начатые докопируются
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    # (файлов готово, всего, байт готово, всего, секунд до конца или None)
+    def snapshot(self):
+        with self._lock:
+            files_done, files_total = self._files_done, self._files_total
+            bytes_done, bytes_total = self._bytes_done, self._bytes_total
+        eta = None
+        if bytes_done:
+            elapsed = time.monotonic() - self._started
+            eta = elapsed * (bytes_total - bytes_done) / bytes_done
+        return files_done, files_total, bytes_done, bytes_total, eta
@@ -0,0 +1,159 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import constants
+from copiers import file_digest, temp_name
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+
+# макеты для печати: для папок размеров (А4, А5, А6, ...) фото уменьшается и обрезается под размер отпечатка
+# и сохраняется в JPEG с нужным DPI в подпапку constants.render_dir_name.
+# считается в пуле процессов - на всех ядрах. Готовые макеты лежат в кэше (constants.render_cache_name)
+# под именем <хэш исходника>_<ширина>x<высота>.jpg - при повторном запуске уже посчитанное не пересчитывается.
+# без Pillow этап пропускается.
+class PrintRenderer:
+    def __init__(self, outdir: Path, logger, progress, metrics, workers: int = constants.render_workers):
+        self._outdir = outdir
+        self._logger = logger
+        self._progress = progress
+        self._metrics = metrics
+        self._workers = workers or os.cpu_count() or 1
+        self._cache_dir = outdir / constants.render_cache_name
+
+    @staticmethod
+    def available():
+        return Image is not None
+
+    # tasks - задачи сортировки, size_to_folder - размер -> папка (BaseSorter.get_size_to_folder).
+    # place=False - макеты остаются только в кэше (например, чтобы положить их в архивы).
+    # возвращает {куда положить макет: файл в кэше} для готовых макетов.
+    def render(self, tasks, size_to_folder: dict, place=True):
+        done = {}
+        jobs = self._jobs(tasks, size_to_folder)
+        if not jobs:
+            return done
+        self._cache_dir.mkdir(exist_ok=True)
+        rendered = cached = 0
+        with self._metrics.phase('render'):
+            with ProcessPoolExecutor(min(self._workers, len(jobs))) as pool:
+                futures = [(src, dsts, pool.submit(render_cached, src, self._cache_dir, size, constants.print_dpi))
+                           for (src, size), dsts in jobs.items()]
+                for src, dsts, future in futures:
+                    if self._progress.cancelled:
+                        for _, _, rest in futures:
+                            rest.cancel()
+                        self._logger.warning('Подготовка макетов для печати отменена.')
+                        break
+                    try:
+                        cache_file, new = future.result()
+                        for dst in dsts:
+                            if place:
+                                _place(cache_file, dst)
+                            done[dst] = cache_file
+                    except Exception as err:
+                        self._logger.error(f'Ошибка при подготовке макета: {src}')
+                        self._logger.error('Текст ошибки: ' + str(err))
+                        continue
+                    rendered += new
+                    cached += not new
+                    if place:
+                        for dst in dsts:
+                            self._logger.info(f'Подготовлен макет {dst.name} в директории {dst.parent}')
+        self._logger.info(f'Макетов для печати: посчитано {rendered}, взято из кэша {cached}')
+        return done
+
+    # (исходник, (ширина, высота) в точках) -> [куда положить макет] для задач в папках известных размеров.
+    # одно фото одного размера в разных папках считается один раз.
+    def _jobs(self, tasks, size_to_folder: dict):
+        folder_to_size = {str(folder): size for size, folder in size_to_folder.items() if folder is not None}
+        jobs = {}
+        unknown = set()
+        for task in tasks:
+            size = self._task_size(task, folder_to_size)
+            if size is None:
+                continue
+            pixels = print_pixels(size)
+            if pixels is None:
+                unknown.add(size)
+                continue
+            for filename in task.filenames:
+                if filename.suffix.lower() not in constants.render_extensions:
+                    continue
+                dst = task.out_dir / constants.render_dir_name / (task.out_file(filename).stem + '.jpg')
+                jobs.setdefault((filename, pixels), []).append(dst)
+        for size in sorted(unknown):
+            self._logger.warning(f'Размер отпечатка {size} неизвестен - макеты не готовятся (см. print_sizes)')
+        return jobs
+
+    def _task_size(self, task, folder_to_size: dict):
+        try:
+            parts = task.out_dir.relative_to(self._outdir).parts
+        except ValueError:
+            parts = task.out_dir.parts
+        for part in reversed(parts):
+            if part in folder_to_size:
+                return folder_to_size[part]
+        return None
+
+
+# размер отпечатка (как в таблице, А -> A) -> (ширина, высота) в точках при constants.print_dpi
+def print_pixels(size: str):
+    mm = constants.print_sizes.get(str(size).upper().replace('А', 'A').replace('Х', 'X'))
+    if mm is None:
+        return None
+    return tuple(round(side / 25.4 * constants.print_dpi) for side in mm)
+
+
+# выполняется в процессе пула: возвращает (файл в кэше, посчитан ли сейчас)
+def render_cached(src: Path, cache_dir: Path, size: tuple, dpi: int):
+    cache_file = cache_dir / f'{file_digest(src).hex()}_{size[0]}x{size[1]}.jpg'
+    if cache_file.exists():
+        return cache_file, False
+    tmp = temp_name(cache_file)
+    try:
+        render_file(src, tmp, size, dpi)
+        os.replace(tmp, cache_file)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return cache_file, True
+
+
+# обрезка по центру под пропорции отпечатка. Ориентация отпечатка - как у фото (горизонтальное остаётся горизонтальным).
+def render_file(src: Path, dst: Path, size: tuple, dpi: int):
+    with Image.open(src) as image:
+        # JPEG сразу декодируется в уменьшенном виде, если он намного больше отпечатка
+        image.draft('RGB', (max(size), max(size)))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        width, height = size
+        if (image.width > image.height) != (width > height):
+            width, height = height, width
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        image.save(dst, 'JPEG', quality=constants.render_quality, dpi=(dpi, dpi))
+
+
+# макет из кэша - в папку размера. Жёсткой ссылкой, если можно (кэш на том же диске).
+def _place(cache_file: Path, dst: Path):
+    # уже на месте (ссылка с прошлого запуска). rename между ссылками на один файл ничего не делает.
+    if dst.exists() and os.path.samefile(cache_file, dst):
+        return
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = temp_name(dst)
+    try:
+        os.unlink(tmp)
+    except OSError:
+        pass
+    try:
+        os.link(cache_file, tmp)
+    except OSError:
+        shutil.copyfile(cache_file, tmp)
+    os.replace(tmp, dst)
@@ -0,0 +1,263 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import constants
+from metrics import RunMetrics
+from progress import Progress
+
+
+# сколько копий идёт одновременно - подбирается по ходу копирования.
+# раз в copy_adapt_interval секунд смотрим скорость (байт/с) и среднее время задачи:
+# стало быстрее - двигаемся дальше в ту же сторону, медленнее - разворачиваемся,
+# скорость та же, а задачи идут дольше - уменьшаем (диск начал "захлёбываться", например USB HDD).
+class ConcurrencyController:
+    def __init__(self, start: int, low: int = constants.copy_concurrency_min,
+                 high: int = constants.copy_concurrency_max, progress=None):
+        self._low = max(1, int(low))
+        self._high = max(self._low, int(high))
+        self.limit = min(max(int(start), self._low), self._high)
+        self._progress = progress if progress is not None else Progress()
+        self._direction = 1
+        self._started = time.monotonic()
+        self._window_started = self._started
+        self._window_bytes = 0
+        self._latencies = []
+        self._last = None
+        # (секунда от начала, сколько копий) - как менялось
+        self.history = [(0.0, self.limit)]
+
+    @property
+    def bounds(self):
+        return self._low, self._high
+
+    def task_done(self, latency: float):
+        self._latencies.append(latency)
+        now = time.monotonic()
+        if now - self._window_started < constants.copy_adapt_interval:
+            return
+        bytes_done = self._progress.snapshot()[2]
+        rate = (bytes_done - self._window_bytes) / (now - self._window_started)
+        latency = sum(self._latencies) / len(self._latencies)
+        self._window_started, self._window_bytes, self._latencies = now, bytes_done, []
+        if self._last is not None:
+            last_rate, last_latency = self._last
+            gain = constants.copy_adapt_gain
+            if rate < last_rate * (1 - gain):
+                self._direction = -self._direction
+            elif rate <= last_rate * (1 + gain) and latency > last_latency * (1 + gain):
+                self._direction = -1
+        self._last = (rate, latency)
+        limit = min(max(self.limit + self._direction, self._low), self._high)
+        # упёрлись в границу - в следующий раз пробуем в другую сторону
+        if limit == self.limit:
+            self._direction = -self._direction
+            return
+        self.limit = limit
+        self.history.append((round(now - self._started, 3), limit))
+
+    # на чём остановились: число копий, которое дольше всего держалось во второй половине копирования
+    def settled(self):
+        if len(self.history) == 1:
+            return self.limit
+        end = time.monotonic() - self._started
+        durations = {}
+        for (at, limit), (next_at, _) in zip(self.history, self.history[1:] + [(end, None)]):
+            if next_at > end / 2:
+                durations[limit] = durations.get(limit, 0) + next_at - max(at, end / 2)
+        return max(durations, key=durations.get)
+
+
+# планировщик копирования: воркеры забирают задачи из общей очереди.
+# новое копирование начинается сразу, как только освободилось место, а не когда закончится вся "волна".
+# adaptive - число одновременных копий подбирает ConcurrencyController (concurrency - с чего начать),
+# иначе оно постоянное.
+# после отмены (progress.cancel()) новые копии не начинаются, начатые докопируются.
+# копии идут в своём пуле потоков по верхней границе (не в общем пуле цикла событий, где потоков может быть
+# меньше и где ещё идёт чтение наперёд) - иначе подбор мерил бы ожидание свободного потока, а не диск.
+class CopyScheduler:
+    def __init__(self, loop, logger, concurrency: int = constants.copy_concurrency, progress=None, metrics=None,
+                 adaptive: bool = constants.copy_adaptive, order=None, low: int = constants.copy_concurrency_min,
+                 high: int = constants.copy_concurrency_max, order_window: int = 1):
+        self._loop = loop
+        self._logger = logger
+        self._concurrency = max(1, int(concurrency))
+        self._progress = progress if progress is not None else Progress()
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        self._controller = ConcurrencyController(self._concurrency, low, high, self._progress) if adaptive else None
+        self._active = 0
+        self._slot_freed = None
+        # order(задачи) -> те же задачи в том порядке, в каком их копировать
+        self._order = order if order is not None else list
+        # при разборе параллельно с копированием упорядочиваем сразу столько новых задач
+        self._order_window = max(1, int(order_window))
+        # задачи в очереди в том же порядке - чтобы знать, какие исходники понадобятся следующими
+        self._upcoming = deque()
+        self._executor = None
+        self._prefetch_executor = None
+
+    # сколько копий шло одновременно (при подборе - на чём остановились)
+    @property
+    def concurrency(self):
+        if self._controller is not None:
+            return self._controller.settled()
+        return self._concurrency
+
+    @property
+    def adaptive(self):
+        return self._controller is not None
+
+    @property
+    def bounds(self):
+        if self._controller is not None:
+            return self._controller.bounds
+        return self._concurrency, self._concurrency
+
+    def run(self, tasks):
+        with self._executors():
+            self._loop.run_until_complete(self.run_async(tasks))
+        self._report()
+
+    async def run_async(self, tasks):
+        self._slot_freed = asyncio.Condition()
+        self._upcoming = deque()
+        queue = asyncio.Queue()
+        for task in self._order(tasks):
+            queue.put_nowait(task)
+            self._upcoming.append(task)
+        # при подборе воркеров - по верхней границе, лишние ждут свободного места
+        workers_num = min(self.bounds[1], queue.qsize())
+        workers = [asyncio.ensure_future(self._worker(queue)) for _ in range(workers_num)]
+        if workers:
+            await asyncio.gather(*workers)
+
+    # разбор таблицы и копирование одновременно.
+    # steps - генератор разбора (отдаёт управление после каждой строки), task_creator сообщает о новых задачах.
+    # очередь ограничена: если копирование не успевает, разбор ждёт.
+    def run_pipeline(self, steps, task_creator):
+        with self._executors():
+            self._loop.run_until_complete(self.run_pipeline_async(steps, task_creator))
+        self._report()
+
+    @contextmanager
+    def _executors(self):
+        self._executor = ThreadPoolExecutor(self.bounds[1])
+        self._prefetch_executor = ThreadPoolExecutor(max(1, constants.readahead_tasks))
+        try:
+            yield
+        finally:
+            self._executor.shutdown()
+            # чтение наперёд не ждём - оно только подсказка ОС
+            self._prefetch_executor.shutdown(wait=False)
+            self._executor = self._prefetch_executor = None
+
+    async def run_pipeline_async(self, steps, task_creator):
+        self._slot_freed = asyncio.Condition()
+        self._upcoming = deque()
+        queue = asyncio.Queue(maxsize=constants.pipeline_queue_size)
+        ready = deque()
+        task_creator.listen(ready.append)
+        workers = [asyncio.ensure_future(self._pipeline_worker(queue)) for _ in range(self.bounds[1])]
+        try:
+            for _ in steps:
+                # отмена - таблицу дальше не разбираем
+                if self._progress.cancelled:
+                    ready.clear()
+                    break
+                if len(ready) >= self._order_window:
+                    await self._put_ready(queue, ready)
+                # даём воркерам забрать задачи и закончить копии
+                await asyncio.sleep(0)
+            await self._put_ready(queue, ready)
+        finally:
+            task_creator.listen(None)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+    # накопленные новые задачи отдаём в работу в заданном порядке, их папки создаём сразу все
+    async def _put_ready(self, queue: asyncio.Queue, ready: deque):
+        if not ready:
+            return
+        batch = self._order(ready)
+        ready.clear()
+        for task in batch:
+            task.create_dirs()
+        for task in batch:
+            await queue.put(task)
+            self._upcoming.append(task)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            await self._acquire()
+            try:
+                task = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                await self._release()
+                return
+            self._took(task)
+            self._metrics.queue_depth(queue.qsize())
+            await self._copy(task)
+
+    async def _pipeline_worker(self, queue: asyncio.Queue):
+        while True:
+            # место занимаем до того, как брать задачу: лишние воркеры не растаскивают очередь
+            await self._acquire()
+            task = await queue.get()
+            # None - задач больше не будет
+            if task is None:
+                await self._release()
+                return
+            self._took(task)
+            self._metrics.queue_depth(queue.qsize())
+            await self._copy(task)
+
+    # задача взята в работу: следующие constants.readahead_tasks исходников просим прочитать заранее
+    def _took(self, task):
+        if self._upcoming and self._upcoming[0] is task:
+            self._upcoming.popleft()
+        for i, upcoming in enumerate(self._upcoming):
+            if i >= constants.readahead_tasks:
+                break
+            upcoming.prefetch(self._prefetch_executor)
+
+    def _limit(self):
+        if self._controller is not None:
+            return self._controller.limit
+        return self._concurrency
+
+    async def _acquire(self):
+        async with self._slot_freed:
+            await self._slot_freed.wait_for(lambda: self._active < self._limit())
+            self._active += 1
+
+    async def _release(self, latency: float = None):
+        async with self._slot_freed:
+            self._active -= 1
+            if latency is not None and self._controller is not None:
+                limit = self._controller.limit
+                self._controller.task_done(latency)
+                if self._controller.limit != limit:
+                    self._metrics.concurrency(self._controller.limit)
+            self._slot_freed.notify_all()
+
+    async def _copy(self, task):
+        latency = None
+        try:
+            if self._progress.cancelled:
+                return
+            started = time.monotonic()
+            await task.copy_file(self._executor)
+            latency = time.monotonic() - started
+            self._metrics.task_latency(latency)
+        except Exception as err:
+            # одна неудачная копия не должна останавливать остальные.
+            self._logger.error(f'Ошибка при копировании: {task}')
+            self._logger.error('Текст ошибки: ' + str(err))
+        finally:
+            await self._release(latency)
+
+    def _report(self):
+        self._metrics.set_concurrency(self.concurrency, *self.bounds)
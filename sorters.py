@@ -1,45 +1,308 @@
-import asyncio
 import os
 import re
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from pathlib import Path
 from openpyxl import load_workbook
 
 import constants
-from tasks import TaskCreator
+from archives import write_archive
+from cell_formats import parse_num_count, parse_num_count_complex
+from copiers import make_copier
+from manifest import Manifest
+from metrics import RunMetrics
+from plan import SortPlan, settings_hash
+from progress import Progress
+from render import PrintRenderer
+from scheduler import CopyScheduler
+from tasks import TaskCreator, order_tasks
+
+
+# правило для одного столбца таблицы, собранное из листа настроек один раз.
+# handler(val, outdir) раскладывает значение ячейки, folder - шаблон папки (с _name_ внутри или без).
+class ColumnRule:
+    def __init__(self, column: int, handler, label: str, folder: Path):
+        self.column = column
+        self.handler = handler
+        self.label = label
+        self._folder = folder
+        # шаблон с _name_ режем заранее, готовые папки запоминаем по ФИО
+        parts = str(folder).split('_name_')
+        self._name_parts = parts if len(parts) > 1 else None
+        self._by_name = {}
+
+    def out_dir(self, name: str = None):
+        if self._name_parts is None or name is None:
+            return self._folder
+        out_dir = self._by_name.get(name)
+        if out_dir is None:
+            out_dir = self._by_name[name] = Path(name.join(self._name_parts))
+        return out_dir
 
 
 class BaseSorter:
+    # читать ли из таблицы значения формул (True) или сами формулы
+    _data_only = False
+
     def __init__(self, table: str, unsorted: str, outdir: str, logger, loop, summary, extension: str,
-                 retush_mode: bool, sub_dir: bool):
+                 retush_mode: bool, sub_dir: bool, concurrency: int = constants.copy_concurrency,
+                 copy_backend: str = constants.copy_backend, bundle_policy: str = constants.bundle_policy,
+                 remove_stale: bool = False, resume: bool = constants.resume, progress: Progress = None,
+                 io_limit=None, index_cache=None, verify: bool = constants.copy_verify,
+                 copy_order: str = constants.copy_order, archive: str = constants.archive_format,
+                 archive_only: bool = constants.archive_only, render: bool = constants.render_prints,
+                 adaptive: bool = constants.copy_adaptive, concurrency_min: int = constants.copy_concurrency_min,
+                 concurrency_max: int = constants.copy_concurrency_max):
         self._summary = summary
-        self._task_creator = TaskCreator(summary, extension, Path(unsorted), sub_dir)
+        # ход сортировки и отмена - окно смотрит на них из своего потока
+        self._progress = progress if progress is not None else Progress()
+        # замеры этапов запуска, сохраняются рядом с манифестом
+        self._metrics = RunMetrics()
+        self._outdir = Path(outdir)
+        # папку для результата создаём только перед копированием (_run_tasks) - пробный запуск диск не трогает
+        self._manifest = Manifest(self._outdir, resume)
+        self._remove_stale = remove_stale
+        # свою же папку с результатом не просматриваем - иначе при повторном запуске возьмём уже разложенные копии.
+        # io_limit и index_cache - общие для нескольких сортировок сразу (пакетный режим, batch.py)
+        self._task_creator = TaskCreator(summary, extension, Path(unsorted), sub_dir,
+                                         make_copier(copy_backend, io_limit, verify), exclude=[self._outdir],
+                                         bundle_policy=bundle_policy, manifest=self._manifest,
+                                         progress=self._progress, index_cache=index_cache,
+                                         metrics=self._metrics)
         self._loop = loop
         self._logger = logger
         self._table = Path(table)
         self._unsorted = Path(unsorted)
-        self._outdir = Path(outdir)
-        self._outdir.mkdir(exist_ok=True)
         self._retush_mode = retush_mode
+        self._options = {'extension': extension, 'retush_mode': retush_mode, 'sub_dir': sub_dir,
+                         'bundle_policy': bundle_policy}
+        self._scheduler = CopyScheduler(loop, logger, concurrency, self._progress, self._metrics,
+                                        adaptive=adaptive, order=partial(order_tasks, order=copy_order),
+                                        low=concurrency_min, high=concurrency_max,
+                                        order_window=1 if copy_order == 'table' else constants.pipeline_order_window)
+        self._size_dirs = {}
+        self._copy_order = copy_order
+        # архивы по папкам назначения (см. _write_archives)
+        self._archive = archive
+        self._archive_only = bool(archive) and archive_only
+        self._io_limit = io_limit
+        self._render = render
+        # настройки прочитанной таблицы (для макетов); при применении готового плана их нет
+        self._settings = None
 
     def sort(self):
+        self._logger.clear()
+        # строки разбираются прямо во время копирования - копии стартуют до конца разбора таблицы.
+        if self._read_table(self._run_tasks) is not None and not self._progress.cancelled:
+            self._show_report()
+        self._save_metrics()
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def summary(self):
+        return self._summary
+
+    # только разбор таблицы, без копирования. Возвращает план сортировки (или None, если таблица не читается).
+    def plan(self):
+        self._logger.clear()
+        self._task_creator.read_only()
+        settings = self._read_table(self._consume_rows)
+        if settings is None:
+            return None
+        return SortPlan.from_tasks(self._task_creator.planned_tasks, self._summary.miss_files,
+                                   self._unsorted, self._outdir, settings_hash(settings, self._options))
+
+    # сверка папки с результатом с планом (без копирования): всё ли на месте и совпадает ли с исходниками
+    def verify(self, plan: SortPlan):
+        self._logger.clear()
+        self._logger.info(f'Проверка по плану, настройки: {plan.settings_hash}')
+        with self._metrics.phase('verify'):
+            for dst, problem in plan.verify(self._unsorted, self._outdir):
+                self._summary.add_mismatch(dst, problem)
+        self._show_mismatches()
+        self._logger.info(f'Проверка окончена, проблем - {len(self._summary.mismatches)}')
+
+    # пробный запуск: показываем план, недостающие файлы и объём, на диск ничего не пишем
+    def dry_run(self):
+        plan = self.plan()
+        if plan is not None:
+            plan.show(self._logger, self._unsorted)
+        return plan
+
+    # копирование по готовому плану - таблица и список файлов не нужны
+    def apply(self, plan: SortPlan):
+        self._logger.clear()
+        self._logger.info(f'План сортировки, настройки: {plan.settings_hash}')
+        for num, out_dir in plan.missed:
+            self._summary.add_miss_file(num, self._outdir / out_dir, '')
+        for entry in plan.entries:
+            self._task_creator.add_planned_task(self._unsorted, entry['num'], self._outdir / entry['out_dir'],
+                                                self._logger, [self._unsorted / source for source in entry['sources']],
+                                                copies=entry['count'], summary=entry['summary'],
+                                                metadata=entry['metadata'])
+        self._run_tasks()
+        if not self._progress.cancelled:
+            self._show_report()
+        self._save_metrics()
+
+    # открываем таблицу, читаем настройки и отдаём разбор строк (генератор _sort_rows) в handle_rows.
+    # возвращает настройки или None, если их прочитать не удалось.
+    def _read_table(self, handle_rows):
+        with self._metrics.phase('workbook_load'):
+            wb = self._open_workbook(data_only=self._data_only)
+        try:
+            # настройки
+            try:
+                with self._metrics.phase('settings_parse'):
+                    settings = self._get_settings(wb)
+            except Exception as err:
+                return None
+            self._settings = settings
+            handle_rows(self._metrics.timed('planning', self._sort_rows(wb, settings)))
+        finally:
+            self._close_workbook(wb)
+        return settings
+
+    def _sort_rows(self, wb, settings):
         raise NotImplementedError
 
-    def _run_tasks(self):
-        concurrency = 5
-        tasks = self._task_creator.tasks
-        while tasks:
-            current_tasks = tasks[:concurrency]
-            tasks = tasks[concurrency:]
-            current_tasks = list(map(lambda task: self._loop.create_task(task.copy_file()),
-                                     current_tasks))  # [loop.create_task(foo()), ioloop.create_task(bar())]
-            current_tasks = asyncio.wait(current_tasks)
-            self._loop.run_until_complete(current_tasks)
+    @staticmethod
+    def _consume_rows(rows):
+        for _ in rows:
+            pass
+
+    def _show_report(self):
+        with self._metrics.phase('report'):
+            # self._rename_vinjetkas()
+            self._summary.show()
+            self._write_summary_report()
+        self._logger.info('Сортировка окончена')
+
+    # замеры запуска - в JSON и CSV рядом с манифестом
+    def _save_metrics(self):
+        # до копирования не дошло (таблица не читается) - и папки с результатом нет
+        if not constants.metrics_report or not self._outdir.is_dir():
+            return
+        files_done, _, bytes_done, _, _ = self._progress.snapshot()
+        self._metrics.set_totals(files_done, bytes_done)
+        try:
+            self._metrics.save_json(self._outdir / (constants.metrics_name + '.json'))
+            self._metrics.save_csv(self._outdir / (constants.metrics_name + '.csv'))
+        except OSError as err:
+            self._logger.warning(f'Не удалось сохранить замеры: {err}')
+
+    # rows - разбор таблицы (генератор, см. _sort_rows). Если передан - копирование идёт параллельно разбору,
+    # иначе копируем уже собранные задачи.
+    def _run_tasks(self, rows=None):
+        self._make_outdir()
+        if self._archive_only:
+            if rows is not None:
+                self._consume_rows(rows)
+        else:
+            with self._metrics.phase('copy'):
+                self._copy_tasks(rows)
+        if self._progress.cancelled:
+            return
+        # макеты готовим до архивов - они попадают и в архивы. Без папок (только архивы) - только в архивы.
+        renders = self._render_prints(place=not self._archive_only) if self._render else {}
+        if self._archive:
+            self._write_archives(renders)
+
+    # папку для результата создаём до того, как смотреть список файлов - она меняет состояние папки с фото.
+    def _make_outdir(self):
+        self._outdir.mkdir(exist_ok=True)
+
+    def _copy_tasks(self, rows=None):
+        # по расположению исходников упорядочиваем весь план сразу: карта памяти читается одним проходом,
+        # а не заново по кусочку на каждую порцию строк
+        if rows is not None and self._copy_order == 'source':
+            self._consume_rows(rows)
+            rows = None
+        if rows is None:
+            self._task_creator.create_dirs()
+            self._scheduler.run(self._task_creator.tasks)
+        else:
+            self._scheduler.run_pipeline(rows, self._task_creator)
+        if self._scheduler.adaptive:
+            low, high = self._scheduler.bounds
+            self._logger.info(f'Одновременных копий: {self._scheduler.concurrency} (подобрано от {low} до {high})')
+        for src, dst in self._task_creator.copier.mismatches:
+            self._summary.add_mismatch(dst, f'копия не совпадает с исходником {src}')
+        if self._progress.cancelled:
+            # готовое уже в журнале - следующий запуск продолжит с этого места
+            self._manifest.close()
+            self._logger.warning('Сортировка отменена. Уже скопированные файлы при следующем запуске '
+                                 'копироваться не будут.')
+            return
+        if self._manifest.resumed:
+            self._logger.info(f'Продолжена прерванная сортировка, готовых файлов в журнале - {self._manifest.resumed}')
+        self._task_creator.finish()
+        # запоминаем, что разложено, для следующего запуска
+        removed = self._manifest.save(self._remove_stale)
+        if self._manifest.reused:
+            self._logger.info(f'Не изменились с прошлой сортировки - {self._manifest.reused} шт.')
+        for out_file in removed:
+            self._logger.info(f'Удалён больше не заказанный файл {out_file}')
+
+    # по архиву на папку назначения. Пишутся, когда план готов - имена с +N_ уже итоговые,
+    # и берутся прямо из исходников: в режиме "только архивы" каждый байт пишется на диск один раз.
+    # renders - макеты для печати: куда лёг бы макет -> файл в кэше. В архиве они в подпапке render_dir_name.
+    def _write_archives(self, renders=None):
+        groups = self._task_creator.archive_groups()
+        for dst, cache_file in (renders or {}).items():
+            files, _ = groups.get(dst.parent.parent, ([], []))
+            files.append((cache_file, f'{constants.render_dir_name}/{dst.name}'))
+        with self._metrics.phase('archive'):
+            with ThreadPoolExecutor(self._scheduler.concurrency) as pool:
+                futures = [(out_dir, tasks, pool.submit(self._write_archive, out_dir, files))
+                           for out_dir, (files, tasks) in groups.items()]
+                for out_dir, tasks, future in futures:
+                    try:
+                        path = future.result()
+                    except Exception as err:
+                        self._logger.error(f'Ошибка при записи архива: {out_dir}')
+                        self._logger.error('Текст ошибки: ' + str(err))
+                        continue
+                    if path is None:
+                        continue
+                    if self._archive_only:
+                        for task in tasks:
+                            task.archived()
+                    self._logger.info(f'Записан архив {path}')
+        if self._progress.cancelled:
+            self._logger.warning('Запись архивов отменена.')
+
+    def _write_archive(self, out_dir: Path, files: list):
+        # общий лимит одновременных копий пакетного режима действует и на архивы
+        if self._io_limit is not None:
+            with self._io_limit:
+                return write_archive(out_dir, files, self._archive, lambda: self._progress.cancelled)
+        return write_archive(out_dir, files, self._archive, lambda: self._progress.cancelled)
+
+    # макеты для печати по папкам размеров из листа настроек. Возвращает {куда лёг бы макет: файл в кэше}.
+    # place=False - в папки не кладём (режим "только архивы").
+    def _render_prints(self, place=True):
+        if self._settings is None:
+            return {}
+        if not PrintRenderer.available():
+            self._logger.warning('Не установлен Pillow - макеты для печати не готовятся.')
+            return {}
+        try:
+            size_to_folder = self.get_size_to_folder(self._settings)
+        except KeyError:
+            self._logger.warning('В настройках нет строки "размер" - макеты для печати не готовятся.')
+            return {}
+        renderer = PrintRenderer(self._outdir, self._logger, self._progress, self._metrics)
+        return renderer.render(self._task_creator.planned_tasks, size_to_folder, place)
 
     def _write_summary_report(self):
         all_files_num = len([f for f in os.listdir(str(self._unsorted))
-                             if os.path.isfile(os.path.join(self._unsorted, f))])
+                             if f not in constants.own_files and os.path.isfile(os.path.join(self._unsorted, f))])
         handled_files_num = len(self._summary.unique_files)
         self._logger.info(f'Обработано файлов {all_files_num}, отобрано - {handled_files_num}.')
         missed_files_num = len(self._summary.miss_files)
@@ -47,6 +310,36 @@ class BaseSorter:
             self._logger.info(f'!!Внимание!!  - Отсутствуют файлы - {missed_files_num} шт.')
             for num, _, metadata in self._summary.miss_files:
                 self._logger.info(f'{metadata} - {num}')
+        self._show_mismatches()
+
+    def _show_mismatches(self):
+        if self._summary.mismatches:
+            self._logger.error(f'!!Внимание!!  - Испорченные или отсутствующие копии - '
+                               f'{len(self._summary.mismatches)} шт.')
+            for path, problem in self._summary.mismatches:
+                self._logger.error(f'{path} - {problem}')
+
+    # книгу открываем только на чтение: строки читаются с диска потоком, без построения всех ячеек и стилей.
+    # после работы книгу нужно закрыть (_close_workbook) - в этом режиме она держит файл открытым.
+    def _open_workbook(self, data_only=False):
+        return load_workbook(self._table, read_only=True, data_only=data_only)
+
+    def _close_workbook(self, wb):
+        wb.close()
+
+    # ленивый перебор строк листа кортежами значений.
+    # в режиме только для чтения пустые ячейки в конце строки могут не прийти, а размер листа
+    # может быть не записан в файле - поэтому дополняем строки None до самой широкой из уже виденных.
+    @staticmethod
+    def _iter_rows(ws):
+        width = ws.max_column or 0
+        for row in ws.iter_rows(values_only=True):
+            values = tuple(row)
+            if len(values) < width:
+                values += (None,) * (width - len(values))
+            else:
+                width = len(values)
+            yield values
 
     def get_size_to_folder(self, settings):
         size_to_folder = {}
@@ -65,16 +358,12 @@ class BaseSorter:
             self._logger.error('Отсутствует лист с настройками. Название листа с настройками должно быть: ' +
                                constants.settings_sheetname)
             raise Exception
-        for ws in wb.worksheets:
-            if ws.title == constants.settings_sheetname:
-                ws_ = ws
-                break
+        ws_ = wb[constants.settings_sheetname]
         # заполняем настроечные данные
         head = None
         settings = {}
         # ищем первую строку в которой есть данные в первом столбце.
-        for row in ws_.values:
-            values = tuple(row)
+        for values in self._iter_rows(ws_):
             # первый столбец не пустой - проверяем что за настройка в нём - нужная ли она для программы.
             # если нет - пропускаем. Список настроек в константах.
             if str(values[0]).lower() in constants.settings_list_reg:
@@ -86,31 +375,80 @@ class BaseSorter:
             raise Exception
         return settings
 
+    # настройки по столбцам -> правила только для тех столбцов, которые надо раскладывать.
+    # всё, что раньше делалось для каждой ячейки (сравнение строк, путь папки, выбор формата), делаем один раз.
+    def _compile_rules(self, settings):
+        size_to_folder = self.get_size_to_folder(settings)
+        rules = []
+        for column, distribute in enumerate(settings.get('распределять', ())):
+            if distribute != 'ДА':
+                continue
+            third_gift = str(self._setting(settings, 'третье в подарок?', column)).upper() == 'ДА'
+            complex_format = str(self._setting(settings, 'сложный формат', column)).upper() == 'ДА'
+            # в режиме ретуши всё кидаем просто в outdir
+            if self._retush_mode:
+                if self._setting(settings, 'раскладывать для ретуши', column) != 'ДА':
+                    continue
+                handler = partial(self._get_by_formats_new_retush, third_gift=third_gift, complex=complex_format)
+                rules.append(ColumnRule(column, handler, 'ретушь', self._outdir))
+                continue
+            # не в режиме ретуши, раскладываем по папкам
+            folder = self._setting(settings, 'папка для складывания', column)
+            try:
+                outdir = self._outdir / folder
+            except Exception as err:
+                self._logger.error('Ошибка при определении пути для складывания: ')
+                self._logger.error('Столбец: ' + str(column))
+                self._logger.error('Значение: ' + str(folder))
+                self._logger.error('Текст ошибки: ' + str(err))
+                continue
+            if complex_format:
+                handler = partial(self._get_by_formats_new_complex, third_gift=third_gift,
+                                  size_to_folder=size_to_folder)
+                rules.append(ColumnRule(column, handler, 'сложный формат', outdir))
+            else:
+                handler = partial(self._get_by_formats_new, third_gift=third_gift)
+                rules.append(ColumnRule(column, handler, 'простой формат', outdir))
+        return rules
+
+    @staticmethod
+    def _setting(settings, name: str, column: int):
+        values = settings.get(name, ())
+        return values[column] if column < len(values) else None
+
+    # раскладываем только столбцы с 3-го и до конца "головы"
+    @staticmethod
+    def _rules_for_head(rules, table_head):
+        return [rule for rule in rules if 2 <= rule.column < len(table_head)]
+
+    # строка со значениями: каждое правило смотрит только на свой столбец
+    def _sort_row(self, values, rules, name: str = None):
+        for rule in rules:
+            value = values[rule.column]
+            # если значений нет - сразу дальше.
+            if value is None:
+                continue
+            val = str(value)
+            try:
+                rule.handler(val, rule.out_dir(name))
+            except Exception as err:
+                self._logger.error(f'Ошибка при обработке строки ({rule.label}): ' + str(values[1]))
+                self._logger.error('Столбец: ' + str(rule.column))
+                self._logger.error('Значение: ' + val)
+                self._logger.error('Текст ошибки: ' + str(err))
+                self._logger.error('-------------------------------------')
+
     # для сложного формата: 1234(2шт)-A4
     # сначала разбиваем по запятым и строкам
     # потом каждый элемент разбиваем по - в левой части получаем номер фото и количество, в правой - размер
     # (хихи, вот и пригодился размер фото)
+    # сам разбор - в cell_formats
     @classmethod
     def _get_num_count_complex(cls, s: str):
-        # приведём все А к одному виду (английскому)
-        s = s.replace('А', 'A')
-        # 1. делаем разбивку по символам новой строки или ,
-        all_list = []
-        list = s.split('\n')
-        for l in list:
-            all_list.extend(l.split(','))
-        # теперь каждый раскладываем по -
-        # тут будет всех по одному.
-        for l in all_list:
-            a = l.split('-')
-
-            multiple_num = re.findall('(\d+)\s*\(?(\d+)\s*шт', a[0])
-            if len(multiple_num) > 0:
-                yield multiple_num[0][0], multiple_num[0][1], a[1].strip()
-            else:
-                all_num = re.findall('(\d+)', a[0])
-                if len(all_num) > 0:
-                    yield all_num[0], 1, a[1].strip()
+        items, error = parse_num_count_complex(s)
+        yield from items
+        if error is not None:
+            raise ValueError(error)
 
     # для простого формата. поддерживаются следующие виды:
     # 1. просто число, например 1234
@@ -119,25 +457,11 @@ class BaseSorter:
     @classmethod
     def _get_num_count(cls, s: str):
         try:
-            all_num = set(re.findall('(\d+)', s))
+            items = parse_num_count(s)
         except TypeError:
             print(s)
             return
-        multiple_num = re.findall('(\d+)\s*\(?(\d+)\s*шт', s)
-        range_num = re.findall('(\d+)[ ]*-[ ]*(\d+).*', s)
-        s1 = set(map(lambda x: x[0], multiple_num))
-        s2 = set(map(lambda x: x[1], multiple_num))
-        s3 = set(map(lambda x: x[0], range_num))
-        s4 = set(map(lambda x: x[1], range_num))
-        all_num = all_num - s1 - s2 - s3 - s4
-
-        for val in multiple_num:
-            yield val
-        for val_st, val_fl in range_num:
-            for i in range(int(val_st), int(val_fl) + 1):
-                yield (str(i), 1)
-        for val in all_num:
-            yield (val, 1)
+        yield from items
 
     # для ретуширования нам не нужно число копий. оставляем оригинальные названия.
     # функция для складывания в одну папку.
@@ -153,32 +477,74 @@ class BaseSorter:
                 self._task_creator.add_task(self._unsorted, num, outdir, self._logger,
                                             copies=int(1), metadata='')
 
+    # обрабатываем сложный формат
+    def _get_by_formats_new_complex(self, val, outdir, third_gift, size_to_folder):
+        numbers = self._get_num_count_complex(val)
+        for num, count, size in numbers:
+            cc = int(count)
+            out_dir = self._size_dir(outdir, size, size_to_folder)
+            if third_gift:
+                if int(count) >= 2:
+                    c = int(count) / 2
+                    cc = int(count) + int(c)
+            self._task_creator.add_task(self._unsorted, num, out_dir, self._logger,
+                                        copies=int(cc), metadata='')
+
+    # папка под размер (_size_ в шаблоне), запоминаем, чтобы не собирать путь на каждый номер
+    def _size_dir(self, outdir, size, size_to_folder):
+        key = (outdir, size)
+        out_dir = self._size_dirs.get(key)
+        if out_dir is None:
+            out_dir = self._size_dirs[key] = Path(str(outdir).replace('_size_', size_to_folder[size]))
+        return out_dir
+
+    # обрабатываем обычный
+    def _get_by_formats_new(self, val, outdir, third_gift):
+        numbers = self._get_num_count(val)
+        for num, count in numbers:
+            cc = int(count)
+            if third_gift:
+                if int(count) >= 2:
+                    c = int(count) / 2
+                    cc = int(count) + int(c)
+            self._task_creator.add_task(self._unsorted, num, outdir, self._logger,
+                                        copies=int(cc), metadata='')
+
 
 class PrintingSorter(BaseSorter):
-    def __init__(self, table: str, unsorted: str, outdir: str, logger, loop, summary, extension: str,
-                 retush_mode: bool, subdir_include: bool):
-        super().__init__(table, unsorted, outdir, logger, loop, summary, extension, retush_mode, subdir_include)
+    _data_only = True
 
-    def sort(self):
-        self._logger.clear()
-        wb = load_workbook(self._table, data_only=True)
-        # настройки
-        try:
-            settings = self._get_settings(wb)
-        except Exception as err:
-            return
-        size_to_folder = self.get_size_to_folder(settings)
+    def __init__(self, table: str, unsorted: str, outdir: str, logger, loop, summary, extension: str,
+                 retush_mode: bool, subdir_include: bool, concurrency: int = constants.copy_concurrency,
+                 copy_backend: str = constants.copy_backend, bundle_policy: str = constants.bundle_policy,
+                 remove_stale: bool = False, resume: bool = constants.resume, progress: Progress = None,
+                 io_limit=None, index_cache=None, verify: bool = constants.copy_verify,
+                 copy_order: str = constants.copy_order, archive: str = constants.archive_format,
+                 archive_only: bool = constants.archive_only, render: bool = constants.render_prints,
+                 adaptive: bool = constants.copy_adaptive, concurrency_min: int = constants.copy_concurrency_min,
+                 concurrency_max: int = constants.copy_concurrency_max):
+        super().__init__(table, unsorted, outdir, logger, loop, summary, extension, retush_mode, subdir_include,
+                         concurrency, copy_backend, bundle_policy, remove_stale, resume, progress,
+                         io_limit, index_cache, verify, copy_order, archive, archive_only,
+                         render, adaptive, concurrency_min, concurrency_max)
+
+    # разбор строк листа с данными. Генератор: отдаёт управление после каждой строки,
+    # чтобы задачи на копирование уходили в работу, пока разбираются следующие строки.
+    def _sort_rows(self, wb, settings):
+        rules = self._compile_rules(settings)
         # лист с данными
 
         ws = wb.worksheets[0]
 
         table_head = None
+        head_rules = []
         # идём построчно
-        for row in ws.values:
-            values = tuple(row)
+        for values in self._iter_rows(ws):
+            yield
             # увидели в столбце B символ № - значит нашли "голову"
             if '№' == values[1]:
                 table_head = values
+                head_rules = self._rules_for_head(rules, table_head)
                 # когда нашли голову - идём на следующую строку и сохраняем значения "головы".
                 continue
             # ищем теперь значащие строки.
@@ -193,111 +559,31 @@ class PrintingSorter(BaseSorter):
                 except (TypeError, ValueError, AttributeError):
                     continue
 
-                # будем итерироваться по длине строки.
-                # начнём с 3-го столбца
-                for l in range(2, len(table_head)):
-                    # если значений нет - сразу дальше.
-                    if values[l] is None:
-                        continue
-                    # смотрим по настройкам и текущему варианту распределения (для ретуши в одну папку, или нет)
-                    if settings['распределять'][l] == 'ДА':
-                        # проверяем, разложение для ретуши или нет.
-                        # в режиме ретуши и раскладываем
-                        if self._retush_mode and settings['раскладывать для ретуши'][l] == 'ДА':
-                            # в данном режиме всё кидаем просто в outdir
-                            val = str(values[l])
-                            try:
-                                self._get_by_formats_new_retush(val, self._outdir,
-                                                            str(settings['третье в подарок?'][l]).upper() == 'ДА',
-                                                            str(settings['сложный формат'][l]).upper() == 'ДА')
-                            except Exception as err:
-                                self._logger.error('Ошибка при обработке строки (ретушь): '+str(values[1]))
-                                self._logger.error('Столбец: ' + str(l))
-                                self._logger.error('Значение: ' + val)
-                                self._logger.error('Текст ошибки: ' + str(err))
-                                self._logger.error('-------------------------------------')
-                                continue
-                        # не в режиме ретуши, раскладываем по папкам
-                        elif not self._retush_mode:
-                            val = str(values[l])
-                            try:
-                                outdir = self._outdir / settings['папка для складывания'][l]
-                                outdir = Path(str(outdir).replace('_name_', name))
-                            except Exception as err:
-                                self._logger.error('Ошибка при определении пути для складывания: ')
-                                self._logger.error('Столбец: ' + str(l))
-                                self._logger.error('Значение: ' + settings['папка для складывания'][l])
-                                self._logger.error('Текст ошибки: ' + str(err))
-                                continue
-                            if str(settings['сложный формат'][l]).upper() == 'ДА':
-                                try:
-                                    self._get_by_formats_new_complex(val, outdir,
-                                                                 str(settings['третье в подарок?'][l]).upper() == 'ДА',
-                                                                 size_to_folder)
-                                except Exception as err:
-                                    self._logger.error('Ошибка при обработке строки (сложный формат): ' + str(values[1]))
-                                    self._logger.error('Столбец: ' + str(l))
-                                    self._logger.error('Значение: ' + val)
-                                    self._logger.error('Текст ошибки: ' + str(err))
-                                    self._logger.error('-------------------------------------')
-                                    continue
-
-                            else:
-                                try:
-                                    self._get_by_formats_new(val, outdir,
-                                                         str(settings['третье в подарок?'][l]).upper() == 'ДА')
-                                except Exception as err:
-                                    self._logger.error('Ошибка при обработке строки (простой формат): ' + str(values[1]))
-                                    self._logger.error('Столбец: ' + str(l))
-                                    self._logger.error('Значение: ' + val)
-                                    self._logger.error('Текст ошибки: ' + str(err))
-                                    self._logger.error('-------------------------------------')
-                                    continue
-
-                        else:
-                            continue
+                self._sort_row(values, head_rules, name)
+
+    ################ OLD CODE
+    # потом удалю.
+    def sort_old(self):
+        self._logger.clear()
+        # старый разбор раскладывает по папкам прямо по ходу - папка для результата нужна сразу
+        self._make_outdir()
+        wb = self._open_workbook()
+        try:
+            self._sort_rows_old(wb)
+        finally:
+            self._close_workbook(wb)
         self._run_tasks()
         # self._rename_vinjetkas()
         self._summary.show()
         self._write_summary_report()
         self._logger.info('Сортировка окончена')
 
-    # обрабатываем сложный формат
-    def _get_by_formats_new_complex(self, val, outdir, third_gift, size_to_folder):
-        numbers = self._get_num_count_complex(val)
-        for num, count, size in numbers:
-            cc = int(count)
-            out_dir = Path(str(outdir).replace('_size_', size_to_folder[size]))
-            if third_gift:
-                if int(count) >= 2:
-                    c = int(count) / 2
-                    cc = int(count) + int(c)
-            self._task_creator.add_task(self._unsorted, num, out_dir, self._logger,
-                                        copies=int(cc), metadata='')
-
-    # обрабатываем обычный
-    def _get_by_formats_new(self, val, outdir, third_gift):
-        numbers = self._get_num_count(val)
-        for num, count in numbers:
-            cc = int(count)
-            if third_gift:
-                if int(count) >= 2:
-                    c = int(count) / 2
-                    cc = int(count) + int(c)
-            self._task_creator.add_task(self._unsorted, num, outdir, self._logger,
-                                        copies=int(cc), metadata='')
-
-    ################ OLD CODE
-    # потом удалю.
-    def sort_old(self):
-        self._logger.clear()
-        wb = load_workbook(self._table)
+    def _sort_rows_old(self, wb):
         ws = wb.worksheets[0]
         table_head = None
         table_sub_head = None
         # идём построчно
-        for row in ws.values:
-            values = tuple(row)
+        for values in self._iter_rows(ws):
             # увидели в столбце B символ № - значит нашли "голову"
             if '№' == values[1]:
                 table_head = values
@@ -353,12 +639,6 @@ class PrintingSorter(BaseSorter):
                 # self._get_gift(values[-6:-3])
                 # self._get_gift(values[-9:-6])
 
-        self._run_tasks()
-        # self._rename_vinjetkas()
-        self._summary.show()
-        self._write_summary_report()
-        self._logger.info('Сортировка окончена')
-
     def _get_by_formats(self, head, values):
         for i in range(0, len(values)):
             if values[i] is None:
@@ -430,29 +710,36 @@ class PrintingSorter(BaseSorter):
 # на данный момент - в альбомах вся информация идёт подряд, без пропусков и без лишних заголовков.
 class AlbumSorter(BaseSorter):
     def __init__(self, table: str, unsorted: str, outdir: str, logger, loop, summary, extension: str,
-                 retush_mode: bool, sub_dir: bool):
-        super().__init__(table, unsorted, outdir, logger, loop, summary, extension, retush_mode, sub_dir)
-
-    def sort(self):
-        self._logger.clear()
-        wb = load_workbook(self._table)
-        # настройки
-        try:
-            settings = self._get_settings(wb)
-        except Exception as err:
-            return
-        size_to_folder = self.get_size_to_folder(settings)
+                 retush_mode: bool, sub_dir: bool, concurrency: int = constants.copy_concurrency,
+                 copy_backend: str = constants.copy_backend, bundle_policy: str = constants.bundle_policy,
+                 remove_stale: bool = False, resume: bool = constants.resume, progress: Progress = None,
+                 io_limit=None, index_cache=None, verify: bool = constants.copy_verify,
+                 copy_order: str = constants.copy_order, archive: str = constants.archive_format,
+                 archive_only: bool = constants.archive_only, render: bool = constants.render_prints,
+                 adaptive: bool = constants.copy_adaptive, concurrency_min: int = constants.copy_concurrency_min,
+                 concurrency_max: int = constants.copy_concurrency_max):
+        super().__init__(table, unsorted, outdir, logger, loop, summary, extension, retush_mode, sub_dir,
+                         concurrency, copy_backend, bundle_policy, remove_stale, resume, progress,
+                         io_limit, index_cache, verify, copy_order, archive, archive_only,
+                         render, adaptive, concurrency_min, concurrency_max)
+
+    # разбор строк листа с данными. Генератор: отдаёт управление после каждой строки,
+    # чтобы задачи на копирование уходили в работу, пока разбираются следующие строки.
+    def _sort_rows(self, wb, settings):
+        rules = self._compile_rules(settings)
         # лист с данными
 
         ws = wb.worksheets[0]
 
         table_head = None
+        head_rules = []
         # идём построчно
-        for row in ws.values:
-            values = tuple(row)
+        for values in self._iter_rows(ws):
+            yield
             # увидели в столбце B символ № - значит нашли "голову"
             if '№' == values[1]:
                 table_head = values
+                head_rules = self._rules_for_head(rules, table_head)
                 # когда нашли голову - идём на следующую строку и сохраняем значения "головы".
                 continue
 
@@ -469,46 +756,24 @@ class AlbumSorter(BaseSorter):
                 if not flag:
                     table_head = None
                     continue
-                # Будем итерироваться по длине строки.
-                # Поскольку нужно следить за значениями сразу в трёх строках
-                # начнём с 3-го столбца
-                for l in range(2, len(table_head)):
-                    # если значений нет - сразу дальше.
-                    if values[l] is None:
-                        continue
-                    # смотрим по настройкам и текущему варианту распределения (для ретуши в одну папку, или нет)
-                    if settings['распределять'][l] == 'ДА':
-                        # проверяем, разложение для ретуши или нет.
-                        # в режиме ретуши и раскладываем
-                        if self._retush_mode and settings['раскладывать для ретуши'][l] == 'ДА':
-                            # в данном режиме всё кидаем просто в outdir
-                            val = values[l]
-                            self._get_by_formats_new_retush(val, self._outdir,
-                                                            str(settings['третье в подарок?'][l]).upper() == 'ДА',
-                                                            str(settings['сложный формат'][l]).upper() == 'ДА')
-                        # не в режиме ретуши, раскладываем по папкам
-                        elif not self._retush_mode:
-                            val = values[l]
-                            outdir = self._outdir / settings['папка для складывания'][l]
-                            if str(settings['сложный формат'][l]).upper() == 'ДА':
-                                self._get_by_formats_new_complex(val, outdir,
-                                                                 str(settings['третье в подарок?'][l]).upper() == 'ДА',
-                                                                 size_to_folder)
-                            else:
-                                self._get_by_formats_new(val, outdir,
-                                                         str(settings['третье в подарок?'][l]).upper() == 'ДА')
-                        else:
-                            continue
-        self._run_tasks()
-        # self._rename_vinjetkas()
-        self._summary.show()
-        self._write_summary_report()
-        self._logger.info('Сортировка окончена')
+                # в альбомах папки по ФИО не раскладываем
+                self._sort_row(values, head_rules)
 
     ###########################OLD CODE
     def sort_old(self):
         self._logger.clear()
-        wb = load_workbook(self._table)
+        # старый разбор раскладывает по папкам прямо по ходу - папка для результата нужна сразу
+        self._make_outdir()
+        wb = self._open_workbook()
+        try:
+            self._sort_rows_old(wb)
+        finally:
+            self._close_workbook(wb)
+        self._run_tasks()
+        self._write_summary_report()
+        self._logger.info('Сортировка окончена')
+
+    def _sort_rows_old(self, wb):
         ws = wb.worksheets[0]
         table_head = None
         kid_counter = 0
@@ -519,8 +784,7 @@ class AlbumSorter(BaseSorter):
         out_all_photo_dir = self._outdir / '1 сортировка - все фотки в одну папку'
         out_all_photo_dir.mkdir(exist_ok=True)
 
-        for row in ws.values:
-            table_values = tuple(row)
+        for table_values in self._iter_rows(ws):
             self._sort_common(table_values,
                               out_dir / '0.Групповые фото',
                               out_all_photo_dir)
@@ -565,10 +829,6 @@ class AlbumSorter(BaseSorter):
                         self._task_creator.add_task(self._unsorted, str(num), out_all_photo_dir, self._logger,
                                                     copies=0, summary=False)
 
-        self._run_tasks()
-        self._write_summary_report()
-        self._logger.info('Сортировка окончена')
-
     def _sort_common(self, values, out_photo_dir, out_all_photo_dir):
         if not isinstance(values[0], str):
             return
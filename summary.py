@@ -0,0 +1,58 @@
+from pathlib import Path
+
+
+# итоги сортировки: сколько фото в какой папке и каких номеров не нашлось.
+class Summary:
+    def __init__(self, logger):
+        self._summary = {}  # dir_name: photo_num
+        self._unique_photos = set()
+        self._miss_files = set()
+        # испорченные или отсутствующие копии (проверка по хэшу): [(путь, что не так)]
+        self._mismatches = []
+        self._logger = logger
+
+    def add(self, dir_name: (str, Path), photo_count: int, photo_name=""):
+        if dir_name not in self._summary.keys():
+            self._summary[dir_name] = photo_count
+        else:
+            self._summary[dir_name] += photo_count
+        self._unique_photos.add(photo_name)
+
+    # кажись костыль не нужен больше.
+    def add_miss_file(self, num, dir, metadata):
+        # TODO: это костыль
+        if len(str(num)) == 4:
+            self._miss_files.add((num, dir, metadata))
+
+    def add_mismatch(self, path: Path, reason: str):
+        self._mismatches.append((path, reason))
+
+    @property
+    def mismatches(self):
+        return self._mismatches
+
+    def get(self, dir_name: (str, Path)):
+        if isinstance(dir_name, str):
+            return self._get_by_name(dir_name)
+        if dir_name in self._summary.keys():
+            return dir_name, self._summary[dir_name]
+        else:
+            return None
+
+    @property
+    def unique_files(self):
+        return self._unique_photos
+
+    @property
+    def miss_files(self):
+        return self._miss_files
+
+    def _get_by_name(self, name: str):
+        for dir_name in self._summary.keys():
+            if dir_name.name == name:
+                return dir_name, self._summary[dir_name]
+        return None
+
+    def show(self):
+        for dir in sorted(self._summary.keys()):
+            self._logger.info(f'В "{dir.name}" - {self._summary[dir]} фото')
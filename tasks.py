@@ -1,83 +1,202 @@
-import glob
+import asyncio
 from pathlib import Path
 
-import aiofiles
-
 import constants
+from copiers import make_copier
+from file_index import FileIndex, strip_file_name
+from metrics import RunMetrics
+from progress import Progress
 
 
 class TaskCreator:
-    def __init__(self, summary, extension, unsorted_dir: Path, sub_dir=False):
+    def __init__(self, summary, extension, unsorted_dir: Path, sub_dir=False, copier=None, exclude=(),
+                 bundle_policy=constants.bundle_policy, manifest=None, progress=None, index_cache=None,
+                 metrics=None):
         self._tasks = {}
+        self._manifest = manifest
+        self._dirs = DirCache()
+        self._progress = progress if progress is not None else Progress()
+        self._sources = {}
+        self._listener = None
         self._summary = summary
         self._extension = extension
-        self._file_list = {}
-        self.fill_file_list(unsorted_dir, sub_dir)
+        self._bundle_policy = bundle_policy
+        # FileIndexCache, общий для нескольких сортировок (пакетный режим)
+        self._index_cache = index_cache
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        # если установлено "ВСЕ" или "ФОТО" - смотрим только фото-расширения, иначе - только заданное.
+        if extension in ('ВСЕ', 'ФОТО'):
+            self._extensions = set(constants.extensions)
+        else:
+            self._extensions = {extension}
+        self._copier = copier if copier is not None else make_copier()
+        self._unsorted_dir = unsorted_dir
+        self._sub_dir = sub_dir
+        self._exclude = exclude
+        # список файлов собираем при первой задаче - при применении готового плана папку смотреть не нужно.
+        self._file_list = None
+        # номер -> файлы, пропущенные из-за совпадения имени с другим файлом комплекта
+        self._duplicates = {}
+        # сохранять ли кэш списка файлов (см. read_only)
+        self._save_index = True
 
     def strip_file_name(self, name: str):
-        import re
-        reg = r'\D*(\d*)[.](\w*)'
-        num, ext = re.findall(reg, name)[0]
-        if ext is not None:
-            ext = ext.lower()
-        return num, str('.'+ext)
+        return strip_file_name(name)
 
     # создадим список файлов, чтобы не заниматься потом фигнёй с поиском файла в цикле.
     # поскольку вариантов может быть по факту много с расширениями.
-    def fill_file_list(self, unsorted_dir: Path, sub_dir=False):
-        # сначала получаем список файлов с заданным расширением.
-        # если установлено "ВСЕ" - не смотрим на расширения
-        if self._extension == 'ВСЕ':
-            for item in Path.iterdir(unsorted_dir):
-                if Path.is_file(item):
-                    num, ext = self.strip_file_name(item.name)
-                    if ext is not None and ext in constants.extensions:
-                        self._file_list[str(num)] = item
-                # если включаем поддиректории, то рекурсивно проходим и подпапки
-                elif sub_dir:
-                    self.fill_file_list(item, sub_dir)
-
-        # если установлено "ФОТО" - смотрим только фото-расширения
-        elif self._extension == 'ФОТО':
-            for item in Path.iterdir(unsorted_dir):
-                if Path.is_file(item):
-                    num, ext = self.strip_file_name(item.name)
-                    if ext is not None and ext in constants.extensions:
-                        self._file_list[str(num)] = item
-                # если включаем поддиректории, то рекурсивно проходим и подпапки
-                elif sub_dir:
-                    self.fill_file_list(item, sub_dir)
-        else:
-            for item in Path.iterdir(unsorted_dir):
-                if Path.is_file(item):
-                    num, ext = self.strip_file_name(item.name)
-                    if ext is not None and ext == self._extension:
-                        self._file_list[str(num)] = item
-                # если включаем поддиректории, то рекурсивно проходим и подпапки
-                elif sub_dir:
-                    self.fill_file_list(item, sub_dir)
+    # сам обход папок (и его кэш между запусками) - в FileIndex.
+    # номер -> все файлы с этим номером (IMG_1234.JPG, IMG_1234.CR2, IMG_1234.xmp...),
+    # какие из них копировать - решает политика комплекта.
+    def fill_file_list(self, unsorted_dir: Path, sub_dir=False, exclude=()):
+        self._file_list = {}
+        self._duplicates = {}
+        with_sidecars = self._bundle_policy != 'single'
+        found = {}
+        with self._metrics.phase('index_scan'):
+            if self._index_cache is not None:
+                files = self._index_cache.files(unsorted_dir, sub_dir, exclude, self._save_index)
+            else:
+                files = FileIndex(unsorted_dir, sub_dir, exclude=exclude).files(self._save_index)
+        for num, ext, item in files:
+            if ext in self._extensions or (with_sidecars and ext in constants.sidecar_extensions):
+                found.setdefault(str(num), []).append(item)
+        for num, files in found.items():
+            bundle = self._unique_names(num, self._select_bundle(files))
+            if bundle:
+                self._file_list[num] = bundle
+
+    # файлы с одинаковым именем из разных папок (две карты памяти) легли бы в одну папку под одним именем.
+    # оставляем последний найденный, как и при одном файле, остальные запоминаем для предупреждения.
+    def _unique_names(self, num: str, bundle: list):
+        by_name = {}
+        for item in bundle:
+            by_name.pop(item.name.lower(), None)
+            by_name[item.name.lower()] = item
+        if len(by_name) == len(bundle):
+            return bundle
+        unique = list(by_name.values())
+        self._duplicates[num] = [item for item in bundle if item not in unique]
+        return unique
+
+    def _select_bundle(self, files: list):
+        main = [item for item in files if item.suffix.lower() in self._extensions]
+        sidecars = [item for item in files if item not in main]
+        if not main:
+            return []
+        # как было раньше - один файл, последний найденный.
+        if self._bundle_policy == 'single':
+            return main[-1:]
+        if self._bundle_policy == 'prefer_raw':
+            main = [item for item in main if item.suffix.lower() in constants.raw_extensions] or main
+        elif self._bundle_policy == 'jpg_sidecar':
+            main = [item for item in main if item.suffix.lower() in constants.jpg_extensions]
+            if not main:
+                return []
+        return main + sidecars
 
     def add_task(self, unsorted_dir: Path, num: str, out_dir: Path, logger, copies: int = 1,
                  summary=True, metadata=None):
-        key = (num, out_dir)
-        summary = self._summary if summary else None
+        if self._file_list is None:
+            self.fill_file_list(self._unsorted_dir, self._sub_dir, self._exclude)
         # !!! файла с таким расширением не нашлось
         if str(num) not in self._file_list.keys():
             if self._summary:
                 self._summary.add_miss_file(num, out_dir, '')
                 return
+        duplicates = self._duplicates.pop(str(num), None)
+        if duplicates:
+            logger.warning(f'Файлы с таким же именем, как у других файлов номера {num}, не копируются: '
+                           + ', '.join(str(item) for item in duplicates))
+        self.add_planned_task(unsorted_dir, num, out_dir, logger, self._file_list[str(num)], copies, summary,
+                              metadata)
+
+    # задача с уже известными файлами (из плана сортировки)
+    def add_planned_task(self, unsorted_dir: Path, num: str, out_dir: Path, logger, filenames: list,
+                         copies: int = 1, summary=True, metadata=None):
+        key = (num, out_dir)
+        summary = self._summary if summary else None
         if key not in self._tasks.keys():
             self._tasks[key] = Task(unsorted_dir, num, out_dir, logger, summary, metadata, self._extension,
-                                    filename=self._file_list[str(num)])
+                                    filenames=filenames, copier=self._copier, progress=self._progress,
+                                    size=self._size(filenames))
+            self._progress.add_total(len(filenames), self._tasks[key].size)
+            self._add_to_source(self._tasks[key])
         self._tasks[key].increase(copies)
 
+    # задачи группируем по исходному комплекту файлов: каждый файл читается один раз
+    # и раскладывается сразу во все папки.
+    def _add_to_source(self, task):
+        key = tuple(task.filenames)
+        if key not in self._sources:
+            self._sources[key] = SourceTask(task.filenames, self._copier, self._manifest, self._dirs)
+        source = self._sources[key]
+        source.add(task)
+        # при разборе параллельно с копированием - сразу отдаём в работу
+        if self._listener is not None and not source.queued:
+            source.queued = True
+            self._listener(source)
+
+    # сколько байт займёт комплект (для хода сортировки). Состояние исходника манифест всё равно запомнит.
+    def _size(self, filenames: list):
+        size = 0
+        for filename in filenames:
+            try:
+                if self._manifest is not None:
+                    size += self._manifest.source_stat(filename).st_size
+                else:
+                    size += filename.stat().st_size
+            except OSError:
+                pass
+        return size
+
+    # listener(source_task) вызывается, когда у исходника появилась новая папка назначения
+    # только план (пробный запуск): кэш списка файлов не пишем
+    def read_only(self):
+        self._save_index = False
+
+    def listen(self, listener):
+        self._listener = listener
+
+    @property
+    def copier(self):
+        return self._copier
+
     @property
     def tasks(self):
+        return list(self._sources.values())
+
+    # все папки назначения создаём заранее, одним проходом (когда задачи известны до копирования)
+    def create_dirs(self):
+        self._dirs.ensure_all(task.out_dir for task in self._tasks.values())
+
+    # задачи по одной на (номер, папка) - для плана сортировки
+    @property
+    def planned_tasks(self):
         return list(self._tasks.values())
 
+    # файлы для архивов: папка назначения -> ([(исходник, имя в архиве)], задачи). Имена - итоговые, с +N_.
+    def archive_groups(self):
+        groups = {}
+        for task in self._tasks.values():
+            files, tasks = groups.setdefault(task.out_dir, ([], []))
+            files.extend((filename, task.out_file(filename).name) for filename in task.filenames)
+            tasks.append(task)
+        return groups
+
+    # всё скопировано: переименовываем файлы, у которых число копий выросло после копирования, и пишем итоги.
+    # в манифест попадают итоговые имена файлов.
+    def finish(self):
+        for task in self._tasks.values():
+            task.finish()
+            if self._manifest is not None and task.copied:
+                for filename in task.filenames:
+                    self._manifest.record(filename, task.out_file(filename), task.count)
+
 
 class Task:
-    def __init__(self, unsorted_dir: Path, num: str, out_dir: Path, logger, summary, metadata, extension, filename):
+    def __init__(self, unsorted_dir: Path, num: str, out_dir: Path, logger, summary, metadata, extension, filenames,
+                 copier=None, progress=None, size=0):
         self._unsorted_dir = unsorted_dir
         self._out_dir = out_dir
         self._logger = logger
@@ -86,19 +205,98 @@ class Task:
         self._summary = summary
         self._metadata = metadata
         self._extension = extension
-        self._filename = filename
+        self._filenames = filenames
+        self._copier = copier if copier is not None else make_copier()
+        self._progress = progress
+        self._size = size
+        self._copied_cnt = None
+        self._copied = False
+        self._finished = False
+
+    # комплект файлов с одним номером (фото, RAW, xmp)
+    @property
+    def filenames(self):
+        return self._filenames
+
+    @property
+    def num(self):
+        return self._num
 
-    async def copy_file(self):
-        async with aiofiles.open(self._filename, mode='rb') as input_file:
-            self._out_dir.mkdir(parents=True, exist_ok=True)
-            out_file_name = self._filename.name if self._cnt <= 1 else f'+{self._cnt}_{self._filename.name}'
-            async with aiofiles.open(str(self._out_dir / out_file_name), mode='wb') as out_file:
-                data = await input_file.read()
-                await out_file.write(data)
+    # объём комплекта в байтах
+    @property
+    def size(self):
+        return self._size
 
-                self._logger.info(f'Скопирован файл {self._filename.name} в директорию {self._out_dir}')
-                if self._summary:
-                    self._summary.add(self._out_dir, self._cnt, photo_name=self._num)
+    @property
+    def count(self):
+        return self._cnt
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def in_summary(self):
+        return self._summary is not None
+
+    @property
+    def out_dir(self):
+        return self._out_dir
+
+    @property
+    def started(self):
+        return self._copied_cnt is not None
+
+    @property
+    def copied_cnt(self):
+        return self._copied_cnt
+
+    @property
+    def copied(self):
+        return self._copied
+
+    def out_file(self, filename: Path, cnt: int = None):
+        cnt = self._cnt if cnt is None else cnt
+        out_file_name = filename.name if cnt <= 1 else f'+{cnt}_{filename.name}'
+        return self._out_dir / out_file_name
+
+    # копирование началось: запоминаем, с каким числом копий назван файл.
+    def start(self):
+        self._copied_cnt = self._cnt
+
+    # reused - файлы, которые остались с прошлой сортировки (не копировались)
+    def done(self, reused=()):
+        self._copied = True
+        for filename in self._filenames:
+            if filename in reused:
+                self._logger.info(f'Файл {filename.name} уже есть в директории {self._out_dir}')
+            else:
+                self._logger.info(f'Скопирован файл {filename.name} в директорию {self._out_dir}')
+        if self._progress is not None:
+            self._progress.advance(len(self._filenames), self._size)
+
+    # если пока шло копирование в таблице нашлись ещё копии этого фото - переименовываем под итоговое число.
+    def finish(self):
+        if not self._copied or self._finished:
+            return
+        self._finished = True
+        if self._copied_cnt != self._cnt:
+            for filename in self._filenames:
+                self.out_file(filename, self._copied_cnt).replace(self.out_file(filename))
+        if self._summary:
+            self._summary.add(self._out_dir, self._cnt, photo_name=self._num)
+
+    # файлы попали только в архив папки (режим без раскладки по папкам)
+    def archived(self):
+        self._copied_cnt = self._cnt
+        self._copied = True
+        self._finished = True
+        for filename in self._filenames:
+            self._logger.info(f'Добавлен файл {filename.name} в архив {self._out_dir}')
+        if self._progress is not None:
+            self._progress.advance(len(self._filenames), self._size)
+        if self._summary:
+            self._summary.add(self._out_dir, self._cnt, photo_name=self._num)
 
     async def copy_file_old(self):
         missed = True
@@ -111,16 +309,13 @@ class Task:
             if not cur_file.exists():
                 continue
             missed = False
-            async with aiofiles.open(cur_file, mode='rb') as input_file:
-                self._out_dir.mkdir(exist_ok=True)
-                out_file_name = cur_file.name if self._cnt <= 1 else f'+{self._cnt}_{cur_file.name}'
-                async with aiofiles.open(str(self._out_dir / out_file_name), mode='wb') as out_file:
-                    data = await input_file.read()
-                    await out_file.write(data)
+            self._out_dir.mkdir(exist_ok=True)
+            out_file_name = cur_file.name if self._cnt <= 1 else f'+{self._cnt}_{cur_file.name}'
+            await self._copier.copy_async(cur_file, self._out_dir / out_file_name)
 
-                    self._logger.info(f'Скопирован файл {cur_file.name} в директорию {self._out_dir}')
-                    if self._summary:
-                        self._summary.add(self._out_dir, self._cnt, photo_name=self._num)
+            self._logger.info(f'Скопирован файл {cur_file.name} в директорию {self._out_dir}')
+            if self._summary:
+                self._summary.add(self._out_dir, self._cnt, photo_name=self._num)
 
         if missed:
             if self._summary:
@@ -134,3 +329,130 @@ class Task:
 
     def __str__(self):
         return self.__repr__()
+
+
+# все копии одного исходного комплекта. Для планировщика это одна задача.
+class SourceTask:
+    def __init__(self, filenames: list, copier, manifest=None, dirs=None):
+        self._filenames = filenames
+        self._copier = copier
+        self._manifest = manifest
+        self._dirs = dirs if dirs is not None else DirCache()
+        self._prefetched = False
+        self._tasks = []
+        # уже скопированный файл назначения для каждого исходника - следующие копии делаем с него
+        self._copied_from = {}
+        # стоит в очереди на копирование
+        self.queued = False
+
+    def add(self, task: Task):
+        self._tasks.append(task)
+
+    @property
+    def filenames(self):
+        return self._filenames
+
+    @property
+    def tasks(self):
+        return self._tasks
+
+    # где исходник лежит на диске: папка, потом номер inode (на одном диске файлы обычно идут в порядке inode),
+    # потом имя. Состояние исходника манифест всё равно запоминает - лишнего stat нет.
+    def locality_key(self):
+        filename = self._filenames[0]
+        try:
+            if self._manifest is not None:
+                inode = self._manifest.source_stat(filename).st_ino
+            else:
+                inode = filename.stat().st_ino
+        except OSError:
+            inode = 0
+        return str(filename.parent), inode, filename.name
+
+    # папки назначения создаём заранее, пока задача ждёт в очереди
+    def create_dirs(self):
+        self._dirs.ensure_all(task.out_dir for task in self._tasks)
+
+    # скоро очередь этой задачи: просим ОС заранее прочитать исходники (в пуле потоков, не дожидаясь)
+    def prefetch(self, executor=None):
+        if self._prefetched:
+            return
+        self._prefetched = True
+        asyncio.get_event_loop().run_in_executor(executor, self._copier.will_need, self._filenames)
+
+    # копируем во все папки, которые ещё не начаты. Если папки добавятся позже (разбор таблицы ещё идёт),
+    # задача снова попадёт в очередь и докопирует их с уже готовой копии.
+    async def copy_file(self, executor=None):
+        self.queued = False
+        tasks = [task for task in self._tasks if not task.started]
+        if not tasks:
+            return
+        for task in tasks:
+            task.start()
+            self._dirs.ensure(task.out_dir)
+        reused = {task: set() for task in tasks}
+        for filename in self._filenames:
+            src = self._copied_from.get(filename, filename)
+            dsts = []
+            for task in tasks:
+                dst = task.out_file(filename, task.copied_cnt)
+                # с прошлой сортировки ничего не поменялось - файл уже на месте
+                if self._manifest is not None and self._manifest.reuse(filename, dst):
+                    reused[task].add(filename)
+                    self._copied_from.setdefault(filename, dst)
+                    self._manifest.journal(filename, dst, task.copied_cnt)
+                else:
+                    dsts.append(dst)
+            if dsts:
+                await self._copier.copy_many_async(src, dsts, executor)
+                self._copied_from.setdefault(filename, dsts[0])
+                if self._manifest is not None:
+                    for task in tasks:
+                        if filename not in reused[task]:
+                            self._manifest.journal(filename, task.out_file(filename, task.copied_cnt),
+                                                   task.copied_cnt)
+        for task in tasks:
+            task.done(reused[task])
+
+    def __repr__(self):
+        return f'<{self.__class__}> Copy "{", ".join(f.name for f in self._filenames)}" to {len(self._tasks)} dirs'
+
+    def __str__(self):
+        return self.__repr__()
+
+
+# папки, созданные за этот запуск: каждую создаём один раз, дальше только смотрим в кэш
+# (на SMB каждый mkdir - поход по сети).
+class DirCache:
+    def __init__(self):
+        self._created = set()
+
+    def ensure(self, path: Path):
+        if path in self._created:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        # вместе с папкой созданы и все её родители
+        while path not in self._created and path != path.parent:
+            self._created.add(path)
+            path = path.parent
+
+    # по порядку путей родитель идёт раньше своих подпапок - на каждую папку не больше одного mkdir
+    def ensure_all(self, paths):
+        for path in sorted(set(paths)):
+            self.ensure(path)
+
+
+# порядок копирования исходников:
+# 'table' - как в таблице, 'destination' - по папкам назначения, чтобы запись шла в одну папку подряд,
+# 'source' - по расположению исходников, чтобы диск с фото (особенно HDD) читался почти подряд.
+# куда и сколько копий - от порядка не зависит.
+def order_tasks(tasks, order: str = constants.copy_order):
+    if order == 'destination':
+        return sorted(tasks, key=_destination_key)
+    if order == 'source':
+        return sorted(tasks, key=SourceTask.locality_key)
+    return list(tasks)
+
+
+def _destination_key(source: SourceTask):
+    return min((str(task.out_dir) for task in source.tasks), default='')